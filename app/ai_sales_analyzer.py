@@ -329,8 +329,9 @@ class SalesAnalyzer:
             cause = self._translate_feature_to_business(feature, day_data, contribution, percentage)
             if cause:
                 causes.append(cause)
-        
-        return causes
+
+        # Убираем дубли, сохраняя порядок (dict сохраняет порядок вставки)
+        return list(dict.fromkeys(causes))
     
     def _translate_feature_to_business(self, feature: str, day_data: pd.Series, 
                                      contribution: float, percentage: float) -> Optional[str]:
@@ -32,25 +32,27 @@ def _safe_mean(s):
 
 
 def _build_platform_block(df: pd.DataFrame, platform_name: str) -> Dict:
+    # Snapshot column set once: one hashed set instead of repeated Index lookups
+    cols = set(df.columns)
     block: Dict = {"platform": platform_name}
     block["sales"] = _safe_sum(df.get("sales"))
     block["orders"] = int(pd.to_numeric(df.get("orders"), errors="coerce").fillna(0).sum())
-    block["cancelled_orders"] = int(pd.to_numeric(df.get("cancelled_orders"), errors="coerce").fillna(0).sum()) if "cancelled_orders" in df.columns else None
-    block["lost_orders"] = int(pd.to_numeric(df.get("lost_orders"), errors="coerce").fillna(0).sum()) if "lost_orders" in df.columns else None
+    block["cancelled_orders"] = int(pd.to_numeric(df.get("cancelled_orders"), errors="coerce").fillna(0).sum()) if "cancelled_orders" in cols else None
+    block["lost_orders"] = int(pd.to_numeric(df.get("lost_orders"), errors="coerce").fillna(0).sum()) if "lost_orders" in cols else None
     block["rating_avg"] = _safe_mean(df.get("rating"))
     block["ads_spend"] = _safe_sum(df.get("ads_spend"))
     block["ads_sales"] = _safe_sum(df.get("ads_sales"))
-    block["impressions"] = int(pd.to_numeric(df.get("impressions"), errors="coerce").fillna(0).sum()) if "impressions" in df.columns else None
+    block["impressions"] = int(pd.to_numeric(df.get("impressions"), errors="coerce").fillna(0).sum()) if "impressions" in cols else None
     # ROAS
     block["roas"] = (block["ads_sales"] / block["ads_spend"]) if block["ads_spend"] else None
     # Operations
-    block["driver_waiting_minutes"] = _safe_mean(df.get("driver_waiting")) if "driver_waiting" in df.columns else None
-    block["accepting_time_min"] = _safe_mean(df.get("accepting_time")) if "accepting_time" in df.columns else None
-    block["preparation_time_min"] = _safe_mean(df.get("preparation_time")) if "preparation_time" in df.columns else None
-    block["delivery_time_min"] = _safe_mean(df.get("delivery_time")) if "delivery_time" in df.columns else None
+    block["driver_waiting_minutes"] = _safe_mean(df.get("driver_waiting")) if "driver_waiting" in cols else None
+    block["accepting_time_min"] = _safe_mean(df.get("accepting_time")) if "accepting_time" in cols else None
+    block["preparation_time_min"] = _safe_mean(df.get("preparation_time")) if "preparation_time" in cols else None
+    block["delivery_time_min"] = _safe_mean(df.get("delivery_time")) if "delivery_time" in cols else None
     # Outages
-    block["offline_rate_avg"] = _safe_mean(df.get("offline_rate")) if "offline_rate" in df.columns else None
-    block["close_time_total_min"] = _safe_sum(df.get("close_time")) if "close_time" in df.columns else None
+    block["offline_rate_avg"] = _safe_mean(df.get("offline_rate")) if "offline_rate" in cols else None
+    block["close_time_total_min"] = _safe_sum(df.get("close_time")) if "close_time" in cols else None
     # Funnel (GRAB only typically)
     if platform_name.lower() == "grab":
         for k in [
@@ -59,7 +61,7 @@ def _build_platform_block(df: pd.DataFrame, platform_name: str) -> Dict:
             "unique_add_to_carts",
             "unique_conversion_reach",
         ]:
-            if k in df.columns:
+            if k in cols:
                 block[k] = int(pd.to_numeric(df.get(k), errors="coerce").fillna(0).sum())
         # CTR and conversions if possible
         impr = block.get("impressions") or block.get("unique_impressions_reach") or 0
@@ -414,12 +416,14 @@ def build_marketing_report(period: str, restaurant_id: Optional[int]) -> Dict:
 
 def _get_restaurant_name(eng, restaurant_id: int) -> Optional[str]:
     try:
-        df = pd.read_sql_query("SELECT name FROM restaurants WHERE id = ?", eng, params=(restaurant_id,))
-        if not df.empty:
-            return str(df.iloc[0]["name"]) if df.iloc[0]["name"] is not None else None
+        # Одиночный скаляр не стоит полного read_sql_query конвейера
+        with eng.connect() as conn:
+            name = conn.exec_driver_sql(
+                "SELECT name FROM restaurants WHERE id = ?", (restaurant_id,)
+            ).scalar()
+        return str(name) if name is not None else None
     except Exception:
         return None
-    return None
 
 
 def _fake_orders_for_platform_period(restaurant_name: Optional[str], platform_key: str, start: date, end: date) -> int:
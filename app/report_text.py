@@ -2,6 +2,8 @@ from __future__ import annotations
 
 from typing import Optional, Dict, Tuple
 from datetime import date
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import sqlite3
 import pandas as pd
 import os
@@ -10,21 +12,29 @@ from app.report_basic import (
     build_basic_report,
     build_marketing_report,
     build_quality_report,
+    _safe_sum,
 )
-from etl.data_loader import get_engine
+from etl.data_loader import get_engine, DEFAULT_SQLITE_PATH
 import numpy as np
 import re
-from ml.inference import load_artifacts, _resolve_preprocessed_feature_groups
+from ml.inference import load_explainer, _resolve_preprocessed_feature_groups
 from etl.feature_engineering import load_holidays_df
 import shap
 import json
 
 
+# Одна C-таблица трансляции вместо str.replace на каждый вызов форматтера
+_SPACE_TRANS = str.maketrans(",", " ")
+
+# Разделитель секций собирается один раз на модуль, а не на каждый вызов
+_DIV = "—" * 72
+
+
 def _fmt_idr(x: Optional[float]) -> str:
     if x is None:
         return "—"
     try:
-        return f"{int(round(float(x))):,} IDR".replace(",", " ")
+        return f"{int(round(float(x))):,} IDR".translate(_SPACE_TRANS)
     except Exception:
         return str(x)
 
@@ -72,7 +82,7 @@ def _section1_exec(basic: Dict) -> str:
 
     lines = []
     lines.append("📊 1. ИСПОЛНИТЕЛЬНОЕ РЕЗЮМЕ")
-    lines.append("—" * 72)
+    lines.append(_DIV)
     lines.append(f"💰 Общая выручка: {total_rev} (GRAB: {grab_rev} + GOJEK: {gojek_rev})")
     lines.append(f"📦 Общие заказы: {total_orders}")
     lines.append(f"   ├── 📱 GRAB: {int(grab.get('orders') or 0)} (успешно: {succ.get('grab','—')}, отмены: {canc.get('grab','—')}, потери: {lost.get('grab','—')}, fake: {fake.get('grab','—')})")
@@ -121,19 +131,108 @@ def _section1_exec(basic: Dict) -> str:
     return "\n".join(lines)
 
 
+_MERGED_DATASET_CSV = "/workspace/data/merged_dataset.csv"
+_METRICS_JSON = "/workspace/ml/artifacts/metrics.json"
+
+
+@lru_cache(maxsize=1)
+def _load_merged_dataset_cached(path: str, mtime: float) -> pd.DataFrame:
+    if path.endswith(".parquet"):
+        df = pd.read_parquet(path)
+    else:
+        df = pd.read_csv(path, parse_dates=["date"])
+    # Узкие типы для ключей фильтрации: меньше байт на строку в масках и
+    # индексе. Флоатовые фичи модели не трогаем, чтобы не сдвигать прогнозы.
+    if "restaurant_id" in df.columns:
+        df["restaurant_id"] = pd.to_numeric(df["restaurant_id"], downcast="integer")
+    if "is_holiday" in df.columns:
+        hol = pd.to_numeric(df["is_holiday"], errors="coerce")
+        if hol.notna().all():
+            df["is_holiday"] = hol.astype("int8")
+    return df
+
+
+def _dataset_source(path: str = _MERGED_DATASET_CSV) -> Optional[Tuple[str, float]]:
+    """Актуальный файл датасета и его mtime.
+
+    Предпочитает parquet-сайдкар (пишется ETL рядом с CSV), когда тот не
+    старее CSV: колоночное чтение быстрее и dtypes не требуют парсинга."""
+    parquet_path = os.path.splitext(path)[0] + ".parquet"
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = None
+    try:
+        p_mtime = os.path.getmtime(parquet_path)
+        if mtime is None or p_mtime >= mtime:
+            return parquet_path, p_mtime
+    except OSError:
+        pass
+    if mtime is None:
+        return None
+    return path, mtime
+
+
+def _load_merged_dataset(path: str = _MERGED_DATASET_CSV) -> pd.DataFrame:
+    """Читает merged_dataset один раз на процесс; mtime в ключе кэша
+    сбрасывает его после перезаписи датасета ETL'ом."""
+    src = _dataset_source(path)
+    if src is None:
+        return pd.DataFrame()
+    try:
+        return _load_merged_dataset_cached(*src)
+    except Exception:
+        # повреждённый parquet или нет движка — читаем CSV
+        if src[0].endswith(".parquet"):
+            try:
+                return _load_merged_dataset_cached(path, os.path.getmtime(path))
+            except OSError:
+                return pd.DataFrame()
+        raise
+
+
+@lru_cache(maxsize=1)
+def _merged_dataset_indexed_cached(path: str, mtime: float) -> pd.DataFrame:
+    # drop=False: колонки остаются на месте, потребители не замечают индекса
+    return _load_merged_dataset_cached(path, mtime).set_index(["restaurant_id", "date"], drop=False).sort_index()
+
+
+def _restaurant_period_slice(restaurant_id: int, start_str: str, end_str: str) -> pd.DataFrame:
+    """Срез (ресторан, период) по сортированному MultiIndex: бинарный поиск
+    и непрерывный срез вместо boolean-скана таблицы всех ресторанов."""
+    src = _dataset_source()
+    if src is None:
+        return pd.DataFrame()
+    try:
+        df = _merged_dataset_indexed_cached(*src)
+    except Exception:
+        df = _load_merged_dataset()
+        if df.empty:
+            return pd.DataFrame()
+        df = df.set_index(["restaurant_id", "date"], drop=False).sort_index()
+    try:
+        sub = df.loc[(restaurant_id, slice(pd.Timestamp(start_str), pd.Timestamp(end_str))), :]
+    except KeyError:
+        return pd.DataFrame()
+    return sub.reset_index(drop=True).copy()
+
+
+@lru_cache(maxsize=4)
+def _dataset_version_banner_cached(metrics_path: str, mtime: float) -> str:
+    with open(metrics_path, "r", encoding="utf-8") as f:
+        m = json.load(f)
+    h = str(m.get("dataset_hash",""))
+    rows = m.get("dataset_rows")
+    ts = m.get("run_at_utc")
+    champ = m.get("champion")
+    short = h[:10] if h else ""
+    return f"Версия датасета: {short} · строк: {rows} · тренировался: {ts} · модель: {champ}"
+
+
 def _dataset_version_banner() -> str:
+    # metrics.json меняется только после обучения — mtime в ключе кэша
     try:
-        metrics_path = "/workspace/ml/artifacts/metrics.json"
-        if not os.path.exists(metrics_path):
-            return ""
-        with open(metrics_path, "r", encoding="utf-8") as f:
-            m = json.load(f)
-        h = str(m.get("dataset_hash",""))
-        rows = m.get("dataset_rows")
-        ts = m.get("run_at_utc")
-        champ = m.get("champion")
-        short = h[:10] if h else ""
-        return f"Версия датасета: {short} · строк: {rows} · тренировался: {ts} · модель: {champ}"
+        return _dataset_version_banner_cached(_METRICS_JSON, os.path.getmtime(_METRICS_JSON))
     except Exception:
         return ""
 
@@ -143,7 +242,7 @@ def _section2_trends(basic: Dict) -> str:
     monthly = st.get("monthly", {})
     lines = []
     lines.append("📈 2. АНАЛИЗ ПРОДАЖ И ТРЕНДОВ")
-    lines.append("—" * 72)
+    lines.append(_DIV)
     lines.append("📊 Динамика по месяцам:")
     for ym in sorted(monthly.keys()):
         m = monthly[ym]
@@ -185,7 +284,7 @@ def _section4_marketing(mkt: Dict) -> str:
     rm = mkt.get("roas_by_month", {})
     lines = []
     lines.append("📈 4. МАРКЕТИНГОВАЯ ЭФФЕКТИВНОСТЬ И ВОРОНКА")
-    lines.append("—" * 72)
+    lines.append(_DIV)
     lines.append("📊 Маркетинговая воронка (только GRAB):")
     lines.append(f"  👁️ Показы рекламы: {int(f.get('impressions') or 0)}")
     lines.append(
@@ -238,7 +337,7 @@ def _section4_marketing(mkt: Dict) -> str:
 def _section5_finance(fin: Dict) -> str:
     lines = []
     lines.append("5. 💳 ФИНАНСОВЫЕ ПОКАЗАТЕЛИ")
-    lines.append("—" * 72)
+    lines.append(_DIV)
     payouts = fin.get("payouts", {})
     total_payouts = payouts.get("total") or 0.0
     grab_p = payouts.get("grab") or 0.0
@@ -280,102 +379,135 @@ def _section5_finance(fin: Dict) -> str:
     return "\n".join(lines)
 
 
-def _parse_time_to_minutes(val: str) -> Optional[float]:
-    if val is None:
-        return None
-    s = str(val)
-    parts = s.split(":")
+def _parse_times_to_minutes(vals: pd.Series) -> pd.Series:
+    """Векторный парсинг колонок времени (HH:MM[:SS] или число) в минуты.
+
+    Неразборчивые значения остаются NaN, чтобы среднее считалось skipna.
+    """
+    s = vals.dropna().astype(str)
+    if s.empty:
+        return pd.Series(dtype=float)
+    parts = s.str.split(":", expand=True)
+    h = pd.to_numeric(parts[0], errors="coerce")
+    m = pd.to_numeric(parts[1], errors="coerce") if parts.shape[1] > 1 else pd.Series(np.nan, index=s.index)
+    sec = pd.to_numeric(parts[2], errors="coerce") if parts.shape[1] > 2 else pd.Series(np.nan, index=s.index)
+    mins = h * 60 + m + sec.fillna(0) / 60.0
+    # Строки без ":" — это уже числовые минуты
+    return mins.mask(~s.str.contains(":", regex=False), h)
+
+
+@lru_cache(maxsize=128)
+def _period_platform_frames_cached(restaurant_id: int, start_str: str, end_str: str,
+                                   db_mtime: float) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    eng = get_engine()
+    # JSON-словари driver_waiting_time разворачиваются JSON1-функциями на
+    # стороне SQLite (приоритет ключей как в старом Python-парсере),
+    # числовые значения проходят как есть
+    qg = (
+        "SELECT stat_date, "
+        "CASE WHEN TRIM(driver_waiting_time) LIKE '{%' THEN "
+        "  CASE WHEN json_valid(driver_waiting_time) THEN "
+        "    COALESCE(json_extract(driver_waiting_time,'$.avg'), json_extract(driver_waiting_time,'$.average'), "
+        "             json_extract(driver_waiting_time,'$.minutes'), json_extract(driver_waiting_time,'$.mean')) "
+        "  END "
+        "ELSE driver_waiting_time END AS driver_waiting_time, "
+        "offline_rate, cancelled_orders, orders, sales, "
+        "new_customers, repeated_customers, reactivated_customers, total_customers, "
+        "earned_new_customers, earned_repeated_customers, earned_reactivated_customers "
+        "FROM grab_stats WHERE restaurant_id=? AND stat_date BETWEEN ? AND ?"
+    )
+    qj = (
+        "SELECT stat_date, accepting_time, preparation_time, delivery_time, driver_waiting, close_time, "
+        "cancelled_orders, lost_orders, orders, sales, new_client, active_client, returned_client "
+        "FROM gojek_stats WHERE restaurant_id=? AND stat_date BETWEEN ? AND ?"
+    )
+    g = pd.read_sql_query(qg, eng, params=(restaurant_id, start_str, end_str))
+    j = pd.read_sql_query(qj, eng, params=(restaurant_id, start_str, end_str))
+    return g, j
+
+
+def _period_platform_frames(restaurant_id: int, start_str: str, end_str: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Однократная выгрузка колонок периода по обеим платформам.
+
+    Секции 3 и 6 работают с одним (restaurant_id, период) — кэш сводит
+    повторные секции того же отчёта к нулю дополнительных SQL-запросов.
+    mtime файла БД в ключе (как у CSV-кэшей выше) сбрасывает кэш, когда
+    ETL дописывает новые строки."""
     try:
-        if len(parts) == 3:
-            h, m, sec = parts
-            return int(h) * 60 + int(m) + int(sec) / 60.0
-        if len(parts) == 2:
-            h, m = parts
-            return int(h) * 60 + int(m)
-        # fallback numeric
-        return float(s)
-    except Exception:
-        return None
+        db_mtime = os.path.getmtime(DEFAULT_SQLITE_PATH)
+    except OSError:
+        db_mtime = 0.0
+    return _period_platform_frames_cached(restaurant_id, start_str, end_str, db_mtime)
 
 
 def _section6_operations(period: str, restaurant_id: int) -> str:
-    eng = get_engine()
     start_str, end_str = period.split("_")
     start = pd.to_datetime(start_str)
     end = pd.to_datetime(end_str)
 
-    # GRAB driver_waiting_time JSON average (seconds -> minutes if needed)
-    qg = (
-        "SELECT driver_waiting_time FROM grab_stats WHERE restaurant_id=? AND stat_date BETWEEN ? AND ? "
-        "AND driver_waiting_time IS NOT NULL"
-    )
-    g = pd.read_sql_query(qg, eng, params=(restaurant_id, start_str, end_str))
-    grab_wait_vals = []
-    for v in g['driver_waiting_time'].dropna().tolist():
-        try:
-            if isinstance(v, str) and v.strip().startswith('{'):
-                d = pd.read_json(pd.io.common.StringIO(v), typ='series') if False else None
-                # Fallback manual parse
-                import json as _json
-                d = _json.loads(v)
-                for k in ('avg','average','minutes','mean'):
-                    if k in d:
-                        val = float(d[k])
-                        # heuristic: if seconds, convert to minutes
-                        grab_wait_vals.append(val/60.0 if val > 60 else val)
-                        break
-            elif isinstance(v, (int, float)):
-                val = float(v)
-                grab_wait_vals.append(val/60.0 if val > 60 else val)
-        except Exception:
-            pass
-    grab_wait_avg = sum(grab_wait_vals)/len(grab_wait_vals) if grab_wait_vals else None
+    g, j = _period_platform_frames(restaurant_id, start_str, end_str)
+
+    # GRAB driver_waiting_time: JSON уже развёрнут JSON1 в SQL, здесь только
+    # эвристика секунды -> минуты и среднее
+    wait_vals = pd.to_numeric(g['driver_waiting_time'], errors='coerce').dropna()
+    grab_wait_avg = float(wait_vals.where(wait_vals <= 60, wait_vals / 60.0).mean()) if len(wait_vals) else None
 
     # GOJEK times
-    qj = (
-        "SELECT accepting_time, preparation_time, delivery_time, driver_waiting, close_time, stat_date "
-        "FROM gojek_stats WHERE restaurant_id=? AND stat_date BETWEEN ? AND ?"
-    )
-    j = pd.read_sql_query(qj, eng, params=(restaurant_id, start_str, end_str))
-    acc = pd.Series([_parse_time_to_minutes(x) for x in j['accepting_time'] if pd.notna(x)])
-    prep = pd.Series([_parse_time_to_minutes(x) for x in j['preparation_time'] if pd.notna(x)])
-    delv = pd.Series([_parse_time_to_minutes(x) for x in j['delivery_time'] if pd.notna(x)])
+    acc = _parse_times_to_minutes(j['accepting_time'])
+    prep = _parse_times_to_minutes(j['preparation_time'])
+    delv = _parse_times_to_minutes(j['delivery_time'])
     drvw = pd.to_numeric(j['driver_waiting'], errors='coerce').dropna()
 
     # cancellations
-    Cg = pd.read_sql_query(
-        "SELECT SUM(cancelled_orders) c FROM grab_stats WHERE restaurant_id=? AND stat_date BETWEEN ? AND ?",
-        eng, params=(restaurant_id, start_str, end_str)
-    ).iloc[0]['c'] or 0
-    Cj_row = pd.read_sql_query(
-        "SELECT SUM(cancelled_orders) c, SUM(lost_orders) l FROM gojek_stats WHERE restaurant_id=? AND stat_date BETWEEN ? AND ?",
-        eng, params=(restaurant_id, start_str, end_str)
-    ).iloc[0]
-    Cj = Cj_row['c'] or 0; Lj = Cj_row['l'] or 0
+    Cg = pd.to_numeric(g['cancelled_orders'], errors='coerce').fillna(0).sum()
+    Cj = pd.to_numeric(j['cancelled_orders'], errors='coerce').fillna(0).sum()
+    Lj = pd.to_numeric(j['lost_orders'], errors='coerce').fillna(0).sum()
     orders_total = (
-        (pd.read_sql_query("SELECT SUM(orders) o FROM grab_stats WHERE restaurant_id=? AND stat_date BETWEEN ? AND ?", eng, params=(restaurant_id, start_str, end_str)).iloc[0]['o'] or 0)
-        + (pd.read_sql_query("SELECT SUM(orders) o FROM gojek_stats WHERE restaurant_id=? AND stat_date BETWEEN ? AND ?", eng, params=(restaurant_id, start_str, end_str)).iloc[0]['o'] or 0)
+        pd.to_numeric(g['orders'], errors='coerce').fillna(0).sum()
+        + pd.to_numeric(j['orders'], errors='coerce').fillna(0).sum()
     )
     cancel_rate = ((Cg + Cj) / orders_total * 100.0) if orders_total else None
 
-    # outages events > 1 hour
-    events = []
-    # GRAB offline_rate in minutes
-    og = pd.read_sql_query(
-        "SELECT stat_date, offline_rate FROM grab_stats WHERE restaurant_id=? AND stat_date BETWEEN ? AND ? AND offline_rate IS NOT NULL",
-        eng, params=(restaurant_id, start_str, end_str)
-    )
-    for _, row in og.iterrows():
-        mins = float(row['offline_rate'] or 0)
-        if mins >= 60.0:
-            events.append((pd.to_datetime(row['stat_date']).date(), 'GRAB', mins/60.0))
-    # GOJEK close_time HH:MM:SS
-    oj = pd.read_sql_query(
-        "SELECT stat_date, close_time FROM gojek_stats WHERE restaurant_id=? AND stat_date BETWEEN ? AND ?",
-        eng, params=(restaurant_id, start_str, end_str)
-    )
-    for _, row in oj.iterrows():
-        ct = str(row['close_time']) if pd.notna(row['close_time']) else ''
+    # Potential losses
+    # average hourly revenue by platform (нужна до скана сбоев)
+    sg = float(pd.to_numeric(g['sales'], errors='coerce').fillna(0).sum())
+    sj = float(pd.to_numeric(j['sales'], errors='coerce').fillna(0).sum())
+    num_days = (end - start).days + 1
+    hr_g = (sg / (num_days*24.0)) if num_days>0 else 0.0
+    hr_j = (sj / (num_days*24.0)) if num_days>0 else 0.0
+
+    # outages events > 1 hour — события (SoA: три параллельных массива)
+    # и агрегаты платформ за один проход
+    event_dates: list = []
+    event_plats: list = []
+    event_hrs: list = []
+    outage_agg = {
+        'GRAB': {'n': 0, 'hrs': 0.0, 'loss': 0.0},
+        'GOJEK': {'n': 0, 'hrs': 0.0, 'loss': 0.0},
+    }
+
+    def _add_event(d, plat: str, hrs: float, hourly_rev: float) -> None:
+        event_dates.append(d)
+        event_plats.append(plat)
+        event_hrs.append(hrs)
+        a = outage_agg[plat]
+        a['n'] += 1
+        a['hrs'] += hrs
+        a['loss'] += hrs * hourly_rev
+
+    # GRAB offline_rate in minutes — один векторный фильтр вместо прохода по строкам
+    og = g.loc[g['offline_rate'].notna(), ['stat_date', 'offline_rate']]
+    og_mins = pd.to_numeric(og['offline_rate'], errors='coerce').fillna(0)
+    crit_mask = og_mins >= 60.0
+    # Даты конвертируются одним векторным to_datetime, не по событию
+    crit_g_dates = pd.to_datetime(og.loc[crit_mask, 'stat_date']).dt.date.to_numpy()
+    for d, mins in zip(crit_g_dates, og_mins[crit_mask].to_numpy()):
+        _add_event(d, 'GRAB', float(mins)/60.0, hr_g)
+    # GOJEK close_time HH:MM:SS — zip по ndarray вместо iterrows (Series на строку)
+    oj = j[['stat_date', 'close_time']]
+    oj_dates = pd.to_datetime(oj['stat_date']).dt.date.to_numpy()
+    for ds, ct_raw in zip(oj_dates, oj['close_time'].to_numpy()):
+        ct = str(ct_raw) if pd.notna(ct_raw) else ''
         parts = ct.split(':')
         seconds = None
         try:
@@ -385,29 +517,14 @@ def _section6_operations(period: str, restaurant_id: int) -> str:
         except Exception:
             seconds = None
         if seconds and seconds >= 3600:
-            events.append((pd.to_datetime(row['stat_date']).date(), 'GOJEK', seconds/3600.0))
+            _add_event(ds, 'GOJEK', seconds/3600.0, hr_j)
 
-    # Potential losses
-    # average hourly revenue by platform
-    # platform sales
-    sg = pd.read_sql_query(
-        "SELECT SUM(sales) s FROM grab_stats WHERE restaurant_id=? AND stat_date BETWEEN ? AND ?",
-        eng, params=(restaurant_id, start_str, end_str)
-    ).iloc[0]['s'] or 0.0
-    sj = pd.read_sql_query(
-        "SELECT SUM(sales) s FROM gojek_stats WHERE restaurant_id=? AND stat_date BETWEEN ? AND ?",
-        eng, params=(restaurant_id, start_str, end_str)
-    ).iloc[0]['s'] or 0.0
-    num_days = (end - start).days + 1
-    hr_g = (sg / (num_days*24.0)) if num_days>0 else 0.0
-    hr_j = (sj / (num_days*24.0)) if num_days>0 else 0.0
-
-    total_loss_g = sum((hrs*hr_g) for (d,plat,hrs) in events if plat=='GRAB')
-    total_loss_j = sum((hrs*hr_j) for (d,plat,hrs) in events if plat=='GOJEK')
+    total_loss_g = outage_agg['GRAB']['loss']
+    total_loss_j = outage_agg['GOJEK']['loss']
 
     lines = []
     lines.append("6. ⏰ ОПЕРАЦИОННЫЕ МЕТРИКИ")
-    lines.append("—" * 72)
+    lines.append(_DIV)
     lines.append("🟢 GRAB:")
     lines.append(f"└── ⏰ Время ожидания водителей: {_fmt_rate(grab_wait_avg,1)} мин")
     lines.append("")
@@ -417,60 +534,56 @@ def _section6_operations(period: str, restaurant_id: int) -> str:
     lines.append(f"└── ⏰ Время ожидания водителей: {_fmt_rate(drvw.mean() if not drvw.empty else None,1)} мин")
     lines.append("")
     lines.append("⚠️ ОПЕРАЦИОННАЯ ЭФФЕКТИВНОСТЬ")
-    lines.append("—" * 72)
+    lines.append(_DIV)
     lines.append("🚫 Отмененные заказы:")
     lines.append(f"   ├── 📱 GRAB: {int(Cg)} заказа")
     lines.append(f"   └── 🛵 GOJEK: {int(Cj)} заказа")
     lines.append(f"   💡 Всего отмененных: {int(Cg+Cj)} заказов ({_fmt_pct(cancel_rate)})")
     lines.append("")
-    if events:
+    if event_dates:
         total_loss = total_loss_g + total_loss_j
         total_sales = sg + sj
         loss_pct = (total_loss/total_sales*100.0) if total_sales else None
         lines.append("🔧 ОПЕРАЦИОННЫЕ СБОИ ПЛАТФОРМ:")
-        # aggregate durations per platform
-        dur_g = sum(hrs for (_,plat,hrs) in events if plat=='GRAB')
-        dur_j = sum(hrs for (_,plat,hrs) in events if plat=='GOJEK')
-        from datetime import timedelta
         def hms_from_hours(h):
             h_int = int(h)
             m = int((h - h_int)*60)
             s = int(round(((h - h_int)*60 - m)*60))
             return f"{h_int}:{m:02d}:{s:02d}"
-        lines.append(f"├── 📱 GRAB: {len([1 for _,p,_ in events if p=='GRAB'])} критичных дня ({hms_from_hours(dur_g)} общее время)")
-        lines.append(f"├── 🛵 GOJEK: {len([1 for _,p,_ in events if p=='GOJEK'])} критичных дня ({hms_from_hours(dur_j)} общее время)")
+        lines.append(f"├── 📱 GRAB: {outage_agg['GRAB']['n']} критичных дня ({hms_from_hours(outage_agg['GRAB']['hrs'])} общее время)")
+        lines.append(f"├── 🛵 GOJEK: {outage_agg['GOJEK']['n']} критичных дня ({hms_from_hours(outage_agg['GOJEK']['hrs'])} общее время)")
         lines.append(f"└── 💸 Потенциальные потери: {_fmt_idr(total_loss)} ({_fmt_pct(loss_pct)})")
-        if events:
-            lines.append("")
-            lines.append("🚨 КРИТИЧЕСКИЕ СБОИ (>1 часа):")
-            # sort by date
-            for d, plat, hrs in sorted(events, key=lambda x: x[0]):
-                loss = hrs*(hr_g if plat=='GRAB' else hr_j)
-                lines.append(f"   • {d}: {plat} offline {hms_from_hours(hrs)} (потери: ~{_fmt_idr(loss)})")
+        lines.append("")
+        lines.append("🚨 КРИТИЧЕСКИЕ СБОИ (>1 часа):")
+        # sort by date
+        for i in np.argsort(np.asarray(event_dates, dtype='datetime64[D]'), kind='stable'):
+            d, plat, hrs = event_dates[i], event_plats[i], event_hrs[i]
+            loss = hrs*(hr_g if plat=='GRAB' else hr_j)
+            lines.append(f"   • {d}: {plat} offline {hms_from_hours(hrs)} (потери: ~{_fmt_idr(loss)})")
     return "\n".join(lines)
 
 
 def _section3_clients(period: str, restaurant_id: int) -> str:
-    eng = get_engine()
     start_str, end_str = period.split("_")
-    qg = (
-        "SELECT SUM(new_customers) new, SUM(repeated_customers) rep, SUM(reactivated_customers) rea, SUM(total_customers) tot, "
-        "SUM(earned_new_customers) enew, SUM(earned_repeated_customers) erep, SUM(earned_reactivated_customers) erea "
-        "FROM grab_stats WHERE restaurant_id=? AND stat_date BETWEEN ? AND ?"
-    )
-    qj = (
-        "SELECT SUM(new_client) new, SUM(active_client) act, SUM(returned_client) ret "
-        "FROM gojek_stats WHERE restaurant_id=? AND stat_date BETWEEN ? AND ?"
-    )
-    g = pd.read_sql_query(qg, eng, params=(restaurant_id, start_str, end_str)).iloc[0].fillna(0)
-    j = pd.read_sql_query(qj, eng, params=(restaurant_id, start_str, end_str)).iloc[0].fillna(0)
-    grab_new, grab_rep, grab_rea, grab_tot = int(g['new']), int(g['rep']), int(g['rea']), int(g['tot'])
-    gojek_new, gojek_act, gojek_ret = int(j['new']), int(j['act']), int(j['ret'])
+    g_df, j_df = _period_platform_frames(restaurant_id, start_str, end_str)
+
+    grab_new = int(_safe_sum(g_df['new_customers']))
+    grab_rep = int(_safe_sum(g_df['repeated_customers']))
+    grab_rea = int(_safe_sum(g_df['reactivated_customers']))
+    grab_tot = int(_safe_sum(g_df['total_customers']))
+    gojek_new = int(_safe_sum(j_df['new_client']))
+    gojek_act = int(_safe_sum(j_df['active_client']))
+    gojek_ret = int(_safe_sum(j_df['returned_client']))
+    g = {
+        'enew': _safe_sum(g_df['earned_new_customers']),
+        'erep': _safe_sum(g_df['earned_repeated_customers']),
+        'erea': _safe_sum(g_df['earned_reactivated_customers']),
+    }
     total_unique = grab_tot + gojek_new + gojek_act + gojek_ret  # верхняя оценка
 
     lines = []
     lines.append("👥 3. ДЕТАЛЬНЫЙ АНАЛИЗ КЛИЕНТСКОЙ БАЗЫ")
-    lines.append("—" * 72)
+    lines.append(_DIV)
     lines.append("📊 Структура клиентской базы (GRAB + GOJEK):")
     lines.append(f"  🆕 Новые клиенты: {grab_new + gojek_new}")
     lines.append(f"    📱 GRAB: {grab_new} | 🛵 GOJEK: {gojek_new}")
@@ -490,14 +603,21 @@ def _section7_quality(quality: Dict) -> str:
     r = quality.get("ratings", {})
     lines = []
     lines.append("7. ⭐ КАЧЕСТВО ОБСЛУЖИВАНИЯ И УДОВЛЕТВОРЕННОСТЬ (GOJEK)")
-    lines.append("—" * 72)
+    lines.append(_DIV)
     total = r.get("total") or 0
     lines.append(f"📊 Распределение оценок (всего: {total}):")
-    lines.append(f"  ⭐⭐⭐⭐⭐ 5 звезд: {r.get('five',0)} ({_fmt_pct((r.get('five',0)/total*100) if total else None)})")
-    lines.append(f"  ⭐⭐⭐⭐ 4 звезды: {r.get('four',0)} ({_fmt_pct((r.get('four',0)/total*100) if total else None)})")
-    lines.append(f"  ⭐⭐⭐ 3 звезды: {r.get('three',0)} ({_fmt_pct((r.get('three',0)/total*100) if total else None)})")
-    lines.append(f"  ⭐⭐ 2 звезды: {r.get('two',0)} ({_fmt_pct((r.get('two',0)/total*100) if total else None)})")
-    lines.append(f"  ⭐ 1 звезда: {r.get('one',0)} ({_fmt_pct((r.get('one',0)/total*100) if total else None)})")
+    # Проценты одной векторной операцией, лейблы — в единственном цикле форматирования
+    star_rows = [
+        ("⭐⭐⭐⭐⭐ 5 звезд", "five"),
+        ("⭐⭐⭐⭐ 4 звезды", "four"),
+        ("⭐⭐⭐ 3 звезды", "three"),
+        ("⭐⭐ 2 звезды", "two"),
+        ("⭐ 1 звезда", "one"),
+    ]
+    counts = np.array([r.get(k, 0) for _, k in star_rows], dtype=float)
+    pcts = counts / total * 100.0 if total else [None] * len(star_rows)
+    for (label, _), c, p in zip(star_rows, counts, pcts):
+        lines.append(f"  {label}: {int(c)} ({_fmt_pct(p)})")
     lines.append("")
     lines.append(f"📈 Индекс удовлетворенности: {_fmt_rate(r.get('satisfaction_index'))}/5.0")
     lines.append(f"🚨 Негативные отзывы (1-2★): {r.get('negative_1_2',{}).get('count',0)} ({_fmt_pct(r.get('negative_1_2',{}).get('percent'))})")
@@ -521,6 +641,7 @@ def _fmt_minutes_to_hhmmss(mins: Optional[float]) -> str:
         return "—"
 
 
+@lru_cache(maxsize=4096)
 def _categorize_feature(name: str) -> str:
     n = name.lower()
     if n.startswith("mkt_") or "ads_spend" in n or "impressions" in n or "roas" in n:
@@ -534,6 +655,35 @@ def _categorize_feature(name: str) -> str:
     return "Other"
 
 
+# Канонизация слов в fallback-именах фич: один проход компилированного
+# регекса вместо цепочки str.replace на каждый вызов
+_PRETTY_WORDS = {"grab": "GRAB", "gojek": "GOJEK", "roas": "ROAS"}
+_PRETTY_WORDS_RE = re.compile(r"grab|gojek|roas")
+
+# Один регекс-классификатор платформенных префиксов вместо каскада startswith
+_FEATURE_PREFIX_RE = re.compile(
+    r"^(?:ops_(?P<op>preparation|accepting|delivery)_time_|mkt_(?P<mkt>roas|ads_spend)_)"
+)
+_OP_LABELS = {
+    "preparation": "время приготовления",
+    "accepting": "время подтверждения",
+    "delivery": "время доставки",
+}
+
+_WEATHER_LAG_RE = re.compile(r"(humidity|wind|temp|rain)_lag")
+
+# Тривиальные фичи, исключаемые из приоритетов секции 9 — компилируется
+# один раз на модуль, а не на каждый вызов
+_SECTION9_EXCLUDE_RE = re.compile(r"^(?:orders_count(?!.*conversion)|total_sales|restaurant_id$)")
+_WEATHER_LAG_LABELS = {
+    "humidity": "влажность",
+    "wind": "ветер",
+    "temp": "температура",
+    "rain": "дождь",
+}
+
+
+@lru_cache(maxsize=4096)
 def _pretty_feature_name(name: str) -> str:
     n = name.lower()
     mapping = {
@@ -569,26 +719,38 @@ def _pretty_feature_name(name: str) -> str:
     }
     if n in mapping:
         return mapping[n]
-    # Heuristics: platform/time metrics
-    if n.startswith("ops_preparation_time_"):
-        plat = n.split("_")[-1].upper()
-        return f"{plat}: время приготовления"
-    if n.startswith("ops_accepting_time_"):
-        plat = n.split("_")[-1].upper()
-        return f"{plat}: время подтверждения"
-    if n.startswith("ops_delivery_time_"):
-        plat = n.split("_")[-1].upper()
-        return f"{plat}: время доставки"
-    if n.startswith("mkt_roas_"):
-        plat = n.split("_")[-1].upper()
-        return f"ROAS ({plat})"
-    if n.startswith("mkt_ads_spend_"):
+    # Heuristics: platform/time metrics — один скан регекса вместо пяти startswith
+    m = _FEATURE_PREFIX_RE.match(n)
+    if m:
         plat = n.split("_")[-1].upper()
+        if m.group("op"):
+            return f"{plat}: {_OP_LABELS[m.group('op')]}"
+        if m.group("mkt") == "roas":
+            return f"ROAS ({plat})"
         return f"Рекламный бюджет ({plat})"
     # Fallback: make readable
     pretty = name.replace("_", " ")
-    pretty = pretty.replace("grab", "GRAB").replace("gojek", "GOJEK").replace("roas", "ROAS")
-    return pretty
+    return _PRETTY_WORDS_RE.sub(lambda m: _PRETTY_WORDS[m.group(0)], pretty)
+
+
+def _shap_matrix(mdl, explainer, X_pre) -> np.ndarray:
+    """Матрица вкладов по строкам X_pre.
+
+    LightGBM умеет считать вклады собственным обходом деревьев
+    (pred_contrib) заметно быстрее универсального TreeExplainer;
+    последний столбец там — ожидание модели, он отбрасывается. Модели
+    без pred_contrib идут через переданный explainer."""
+    try:
+        contrib = mdl.predict(X_pre, pred_contrib=True)
+        return np.asarray(contrib)[:, :-1]
+    except TypeError:
+        return explainer.shap_values(X_pre)
+
+
+# Приоритет фактора по доле потерь: один searchsorted вместо цепочки
+# сравнений в каждом цикле
+_PRI_THR = np.array([7.0, 15.0])
+_PRI_EMOJI = ("🟢", "🟡", "🔴")
 
 
 # Пороговые значения для стабилизации раздела 8
@@ -596,24 +758,17 @@ MIN_NEG_SHARE = 0.02  # Минимальная доля негативного 
 MIN_NEG_IDR = 100000  # Минимальный вклад в IDR (100K IDR)
 REPORT_STRICT_MODE = True  # Строгий режим: требует минимум данных
 
+@lru_cache(maxsize=4096)
 def _normalize_feature_name(feature: str) -> str:
     """Нормализация названий фич в человекочитаемые"""
     # Объединяем дублеры времени приготовления
     if any(x in feature.lower() for x in ['prep_time', 'preparation_time']):
         return "Время приготовления"
     
-    # Объединяем погодные лаги
-    if any(x in feature.lower() for x in ['humidity_lag', 'wind_lag', 'temp_lag', 'rain_lag']):
-        weather_type = ""
-        if 'humidity' in feature.lower():
-            weather_type = "влажность"
-        elif 'wind' in feature.lower():
-            weather_type = "ветер"
-        elif 'temp' in feature.lower():
-            weather_type = "температура"
-        elif 'rain' in feature.lower():
-            weather_type = "дождь"
-        return f"Погода: {weather_type} (предыдущие дни)"
+    # Объединяем погодные лаги: один регекс вместо четырёх substring-проверок
+    m = _WEATHER_LAG_RE.search(feature.lower())
+    if m:
+        return f"Погода: {_WEATHER_LAG_LABELS[m.group(1)]} (предыдущие дни)"
     
     # Текущие погодные условия
     if feature.lower() in ['rain', 'humidity', 'wind', 'temp', 'temperature']:
@@ -662,25 +817,27 @@ def _section8_critical_days_ml(period: str, restaurant_id: int) -> str:
     """Улучшенный раздел 8 с пороговыми значениями и строгой фильтрацией"""
     try:
         start_str, end_str = period.split("_")
-        df = pd.read_csv("/workspace/data/merged_dataset.csv", parse_dates=["date"])
-        sub = df[(df["restaurant_id"] == restaurant_id) & (df["date"] >= start_str) & (df["date"] <= end_str)].copy()
+        if _dataset_source() is None:
+            raise FileNotFoundError(_MERGED_DATASET_CSV)
+        sub = _restaurant_period_slice(restaurant_id, start_str, end_str)
         
         if sub.empty:
-            return "8. 🚨 КРИТИЧЕСКИЕ ДНИ\n════════════════════════════════════════════════════════════════════════\nНет данных за выбранный период."
+            return "8. 🚨 КРИТИЧЕСКИЕ ДНИ (ML)\n════════════════════════════════════════════════════════════════════════\nНет данных за выбранный период."
         
         # Строгий режим: проверяем достаточность данных
         if REPORT_STRICT_MODE and len(sub) < 7:
-            return "8. 🚨 КРИТИЧЕСКИЕ ДНИ\n════════════════════════════════════════════════════════════════════════\nДанных недостаточно для анализа (минимум 7 дней)."
+            return "8. 🚨 КРИТИЧЕСКИЕ ДНИ (ML)\n════════════════════════════════════════════════════════════════════════\nДанных недостаточно для анализа (минимум 7 дней)."
 
         # Находим критические дни (падение ≥30% от медианы)
         daily = sub.groupby("date", as_index=False)["total_sales"].sum().sort_values("date")
         median_sales = float(daily["total_sales"].median()) if len(daily) else 0.0
         threshold = 0.70 * median_sales  # 30% падение от медианы
-        critical_dates = daily.loc[daily["total_sales"] <= threshold, "date"].dt.normalize().tolist()
-        critical_dates = sorted(critical_dates, key=lambda d: daily.loc[daily["date"] == d, "total_sales"].iloc[0])
+        # Дата-индексированная серия: hash-lookup вместо полного скана на каждый день
+        daily_sales = daily.set_index(daily["date"].dt.normalize())["total_sales"]
+        critical_dates = daily_sales[daily_sales <= threshold].sort_values(kind="stable").index.tolist()
 
         lines: list[str] = []
-        lines.append("8. 🚨 КРИТИЧЕСКИЕ ДНИ")
+        lines.append("8. 🚨 КРИТИЧЕСКИЕ ДНИ (ML)")
         lines.append("════════════════════════════════════════════════════════════════════════")
         
         # Заголовок с основной статистикой
@@ -691,28 +848,76 @@ def _section8_critical_days_ml(period: str, restaurant_id: int) -> str:
         if not critical_dates:
             lines.append("")
             lines.append("✅ В периоде нет критических дней (падение ≥30%)")
-            return "\\n".join(lines)
+            return "\n".join(lines)
         
         # Подсчитываем общие потери
-        total_losses = 0.0
-        for critical_date in critical_dates:
-            day_sales = daily.loc[daily["date"] == critical_date, "total_sales"].iloc[0]
-            loss = max(median_sales - day_sales, 0)
-            total_losses += loss
-        
+        total_losses = float((median_sales - daily_sales.loc[critical_dates]).clip(lower=0).sum())
+
         lines.append(f"💸 Общие потери от критических дней: {_fmt_idr(total_losses)}")
         lines.append("")
-        
-        def _analyze_critical_day_improved(critical_date: pd.Timestamp) -> list[str]:
+
+        # Индекс по дате: hash-lookup строк дня вместо boolean-скана sub
+        sub_by_date = sub.set_index("date", drop=False)
+
+        # Модель, препроцессированный background и explainer строятся один раз
+        # на отчёт и переиспользуются всеми критическими днями
+        ml_ctx = None
+        try:
+            model, features, pre, mdl, explainer = load_explainer()
+            if model is not None and features:
+                ml_ctx = (features, pre, mdl, explainer)
+        except Exception:
+            ml_ctx = None
+
+        # Артефактов нет — в строгом режиме выходим сразу, не раскручивая
+        # per-day анализ с одним и тем же сообщением на каждый день
+        if ml_ctx is None and REPORT_STRICT_MODE:
+            lines.append("### ⚠️ **АНАЛИЗ НЕДОСТУПЕН**")
+            lines.append("ML модель не обучена. Запустите обучение для получения детального анализа.")
+            return "\n".join(lines)
+
+        # SHAP для всех критических дней одной матрицей: накладные расходы
+        # explainer'а платятся один раз, а не на каждый день
+        shap_by_date: Dict = {}
+        if ml_ctx is not None:
+            features, pre, mdl, explainer = ml_ctx
+            if all(f in sub.columns for f in features):
+                try:
+                    crit_rows = (
+                        sub.loc[sub["date"].isin(critical_dates)]
+                        .drop_duplicates(subset="date", keep="first")
+                        .set_index("date")
+                    )
+                    shap_all = _shap_matrix(mdl, explainer, pre.transform(crit_rows[features]))
+                    shap_by_date = {d: shap_all[i] for i, d in enumerate(crit_rows.index)}
+                except Exception:
+                    shap_by_date = {}
+
+        # Скалярные ряды критических дней одним срезом: позиционные массивы
+        # вместо pandas-доступа day_data.get(...) на каждый день
+        crit_first = sub_by_date.loc[~sub_by_date.index.duplicated(keep="first")].reindex(critical_dates)
+        crit_present = np.asarray([d in sub_by_date.index for d in critical_dates])
+
+        def _crit_col(col: str) -> np.ndarray:
+            if col in crit_first.columns:
+                return pd.to_numeric(crit_first[col], errors="coerce").fillna(0).to_numpy(float)
+            return np.zeros(len(crit_first))
+
+        crit_sales = _crit_col("total_sales")
+        crit_orders = _crit_col("orders_count")
+        crit_hol = _crit_col("is_holiday")
+        crit_rain = _crit_col("rain")
+        crit_temp = _crit_col("temp")
+
+        def _analyze_critical_day_improved(pos: int, critical_date: pd.Timestamp) -> list[str]:
             """Улучшенный анализ критического дня с пороговыми значениями"""
             day_lines = []
+            fmt = _fmt_idr  # локальное имя: без lookup'а модуля на каждую строку
             
-            # Получаем данные дня
-            day_data = sub[sub["date"] == critical_date].iloc[0] if not sub[sub["date"] == critical_date].empty else None
-            if day_data is None:
+            if not crit_present[pos]:
                 return [f"🔴 {critical_date.strftime('%Y-%m-%d')}: нет данных"]
-            
-            day_sales = float(day_data["total_sales"])
+
+            day_sales = float(crit_sales[pos])
             loss_amount = max(median_sales - day_sales, 0)
             loss_pct = ((day_sales - median_sales) / median_sales * 100) if median_sales > 0 else 0
             
@@ -725,7 +930,7 @@ def _section8_critical_days_ml(period: str, restaurant_id: int) -> str:
             day_lines.append(f"- **Потери:** {_fmt_idr(loss_amount)}")
             
             # Получаем заказы и средний чек если есть
-            orders = day_data.get("orders_count", 0) or 0
+            orders = crit_orders[pos]
             if orders > 0:
                 avg_check = day_sales / orders
                 day_lines.append(f"- **Заказы:** {orders} шт")
@@ -735,59 +940,47 @@ def _section8_critical_days_ml(period: str, restaurant_id: int) -> str:
             
             # ML анализ причин с пороговыми значениями
             try:
-                model, features, background = load_artifacts()
-                if model is None or not features:
-                    if REPORT_STRICT_MODE:
-                        day_lines.append("### ⚠️ **АНАЛИЗ НЕДОСТУПЕН**")
-                        day_lines.append("ML модель не обучена. Запустите обучение для получения детального анализа.")
-                        return day_lines
-                
-                # Получаем SHAP значения для дня
-                day_features = day_data[features] if all(f in day_data.index for f in features) else None
-                if day_features is None:
+                if ml_ctx is None:
+                    # нестрогий режим: день остаётся с ключевыми цифрами
+                    return day_lines
+                features = ml_ctx[0]
+
+                # SHAP значения дня — из заранее посчитанной матрицы
+                shap_values = shap_by_date.get(critical_date)
+                if shap_values is None:
                     if REPORT_STRICT_MODE:
                         day_lines.append("### ⚠️ **ДАННЫХ НЕДОСТАТОЧНО**")
                         day_lines.append("Отсутствуют необходимые features для ML анализа.")
                         return day_lines
                 
-                X_day = day_features.values.reshape(1, -1)
-                pre = model.named_steps["pre"]
-                mdl = model.named_steps["model"]
-                X_pre = pre.transform(X_day)
-                
-                if background is not None and not background.empty:
-                    bg_pre = pre.transform(background[features])
-                    explainer = shap.TreeExplainer(mdl, data=bg_pre, feature_perturbation="interventional")
-                else:
-                    explainer = shap.TreeExplainer(mdl, feature_perturbation="interventional")
-                
-                shap_values = explainer.shap_values(X_pre)[0]
-                
-                # Фильтруем негативные факторы по пороговым значениям
-                negative_factors = []
-                positive_factors = []
-                
-                for i, (feature, shap_val) in enumerate(zip(features, shap_values)):
-                    if shap_val < 0:  # Негативный вклад
-                        contribution_idr = abs(shap_val)
-                        contribution_share = abs(shap_val) / loss_amount if loss_amount > 0 else 0
-                        
-                        # Применяем пороговые значения
-                        if contribution_share >= MIN_NEG_SHARE and contribution_idr >= MIN_NEG_IDR:
-                            normalized_name = _normalize_feature_name(feature)
-                            negative_factors.append((normalized_name, contribution_idr, contribution_share * 100))
-                    
-                    elif shap_val > 0:  # Позитивный вклад (что помогло)
-                        contribution_idr = shap_val
-                        normalized_name = _normalize_feature_name(feature)
-                        positive_factors.append((normalized_name, contribution_idr))
-                
-                # Сортируем по вкладу и берем топ-5
-                negative_factors.sort(key=lambda x: x[1], reverse=True)
-                negative_factors = negative_factors[:5]
-                
-                positive_factors.sort(key=lambda x: x[1], reverse=True)
-                positive_factors = positive_factors[:3]  # Топ-3 помогающих фактора
+                # Пороговая фильтрация вкладов масками NumPy вместо
+                # Python-цикла по фичам
+                n = min(len(features), len(shap_values))
+                sv = np.asarray(shap_values[:n], dtype=float)
+                contrib = -sv
+                share = contrib / loss_amount if loss_amount > 0 else np.zeros_like(contrib)
+                neg_keep = (sv < 0) & (share >= MIN_NEG_SHARE) & (contrib >= MIN_NEG_IDR)
+
+                def _top_k(idx: np.ndarray, scores: np.ndarray, k: int) -> np.ndarray:
+                    # argpartition отбирает k кандидатов за O(F), сортируются
+                    # только они; имена материализуются только для топа
+                    if len(idx) > k:
+                        idx = idx[np.argpartition(-scores[idx], k)[:k]]
+                    return idx[np.argsort(-scores[idx], kind="stable")]
+
+                neg_idx = np.flatnonzero(neg_keep)
+                negative_factors = [
+                    (_normalize_feature_name(features[i]), float(contrib[i]), float(share[i] * 100))
+                    for i in _top_k(neg_idx, contrib, 5)
+                ]
+                positive_factors = [
+                    (_normalize_feature_name(features[i]), float(sv[i]))
+                    for i in _top_k(np.flatnonzero(sv > 0), sv, 3)  # Топ-3 помогающих фактора
+                ]
+                priorities = [
+                    _PRI_EMOJI[k]
+                    for k in np.searchsorted(_PRI_THR, [p for _, _, p in negative_factors], side="right")
+                ]
                 
                 # Строгий режим: проверяем достаточность факторов
                 if REPORT_STRICT_MODE and len(negative_factors) < 2:
@@ -799,21 +992,23 @@ def _section8_critical_days_ml(period: str, restaurant_id: int) -> str:
                 day_lines.append("### 🔍 **РЕАЛЬНЫЕ ПРИЧИНЫ**")
                 
                 for i, (factor_name, contribution_idr, contribution_pct) in enumerate(negative_factors, 1):
-                    priority = "🔴" if contribution_pct >= 15.0 else ("🟡" if contribution_pct >= 7.0 else "🟢")
-                    day_lines.append(f"**{i}. {priority} {factor_name.upper()}**")
-                    day_lines.append(f"- **Влияние:** {_fmt_idr(contribution_idr)} ({contribution_pct:.1f}% от потерь)")
-                    day_lines.append("")
+                    priority = priorities[i - 1]
+                    day_lines.append(
+                        f"**{i}. {priority} {factor_name.upper()}**\n"
+                        f"- **Влияние:** {fmt(contribution_idr)} ({contribution_pct:.1f}% от потерь)\n"
+                    )
                 
                 # Внешние факторы (праздники и погода) только если превышают пороги
                 day_lines.append("### 🌍 **ВНЕШНИЕ ФАКТОРЫ**")
                 
                 # Праздники - только если holiday_flag==1 и вклад >= порога
-                is_holiday = int(day_data.get("is_holiday", 0)) == 1
+                is_holiday = int(crit_hol[pos]) == 1
                 holiday_contribution = 0
                 
                 # Ищем вклад праздника в негативных факторах
                 for factor_name, contribution_idr, contribution_pct in negative_factors:
-                    if "праздник" in factor_name.lower() or "holiday" in factor_name.lower():
+                    name_lc = factor_name.lower()
+                    if "праздник" in name_lc or "holiday" in name_lc:
                         holiday_contribution = contribution_idr
                         break
                 
@@ -827,12 +1022,13 @@ def _section8_critical_days_ml(period: str, restaurant_id: int) -> str:
                     day_lines.append("**🕌 Праздники:** обычный день")
                 
                 # Дождь - только если rain_mm >= 2.0 и вклад >= порога
-                rain_mm = float(day_data.get("rain", 0)) if pd.notna(day_data.get("rain")) else 0.0
+                rain_mm = float(crit_rain[pos])
                 rain_contribution = 0
                 
                 # Ищем вклад дождя в негативных факторах
                 for factor_name, contribution_idr, contribution_pct in negative_factors:
-                    if "дождь" in factor_name.lower() or "rain" in factor_name.lower():
+                    name_lc = factor_name.lower()
+                    if "дождь" in name_lc or "rain" in name_lc:
                         rain_contribution = contribution_idr
                         break
                 
@@ -842,7 +1038,7 @@ def _section8_critical_days_ml(period: str, restaurant_id: int) -> str:
                 elif rain_mm >= 2.0:
                     day_lines.append(f"**🌧️ Погода:** дождь {rain_mm:.1f}мм (влияние незначительное)")
                 else:
-                    temp = day_data.get("temp", 0) or 0
+                    temp = crit_temp[pos] or 0
                     day_lines.append(f"**🌧️ Погода:** без дождя, комфортная температура {temp}°C")
                 
                 day_lines.append("")
@@ -851,8 +1047,10 @@ def _section8_critical_days_ml(period: str, restaurant_id: int) -> str:
                 if positive_factors:
                     day_lines.append("### ✅ **ЧТО ПОМОГЛО ИЗБЕЖАТЬ БОЛЬШИХ ПОТЕРЬ**")
                     for factor_name, contribution_idr in positive_factors:
-                        day_lines.append(f"**💪 {factor_name}:**")
-                        day_lines.append(f"- Положительный эффект: +{_fmt_idr(contribution_idr)}")
+                        day_lines.append(
+                            f"**💪 {factor_name}:**\n"
+                            f"- Положительный эффект: +{fmt(contribution_idr)}"
+                        )
                     day_lines.append("")
                 
                 # Конкретные рекомендации с финансовым эффектом
@@ -862,27 +1060,28 @@ def _section8_critical_days_ml(period: str, restaurant_id: int) -> str:
                 total_potential = 0
                 
                 for i, (factor_name, contribution_idr, contribution_pct) in enumerate(negative_factors[:3], 1):
-                    priority = "🔴" if contribution_pct >= 15.0 else ("🟡" if contribution_pct >= 7.0 else "🟢")
-                    
+                    priority = priorities[i - 1]
+                    name_lc = factor_name.lower()
+
                     # Генерируем рекомендации на основе типа фактора
-                    if "бюджет" in factor_name.lower():
+                    if "бюджет" in name_lc:
                         rec_effect = contribution_idr * 0.8  # 80% восстановления
                         recommendations.append(f"**{i}. {priority} Оптимизировать рекламный бюджет**")
                         recommendations.append(f"- **Потенциальный эффект:** {_fmt_idr(rec_effect)}")
                         total_potential += rec_effect
-                    elif "время" in factor_name.lower():
+                    elif "время" in name_lc:
                         rec_effect = contribution_idr * 0.6  # 60% восстановления
                         recommendations.append(f"**{i}. {priority} Ускорить операционные процессы**")
                         recommendations.append(f"- **Потенциальный эффект:** {_fmt_idr(rec_effect)}")
                         total_potential += rec_effect
-                    elif "рейтинг" in factor_name.lower():
+                    elif "рейтинг" in name_lc:
                         rec_effect = contribution_idr * 0.7  # 70% восстановления
                         recommendations.append(f"**{i}. {priority} Улучшить качество сервиса**")
                         recommendations.append(f"- **Потенциальный эффект:** {_fmt_idr(rec_effect)}")
                         total_potential += rec_effect
                     else:
                         rec_effect = contribution_idr * 0.5  # 50% восстановления по умолчанию
-                        recommendations.append(f"**{i}. {priority} Исправить {factor_name.lower()}**")
+                        recommendations.append(f"**{i}. {priority} Исправить {name_lc}**")
                         recommendations.append(f"- **Потенциальный эффект:** {_fmt_idr(rec_effect)}")
                         total_potential += rec_effect
                 
@@ -905,8 +1104,8 @@ def _section8_critical_days_ml(period: str, restaurant_id: int) -> str:
             return day_lines
         
         # Анализируем ВСЕ критические дни с новой логикой
-        for critical_date in critical_dates:
-            day_analysis = _analyze_critical_day_improved(critical_date)
+        for pos, critical_date in enumerate(critical_dates):
+            day_analysis = _analyze_critical_day_improved(pos, critical_date)
             lines.extend(day_analysis)
         
         # Общие выводы
@@ -917,19 +1116,12 @@ def _section8_critical_days_ml(period: str, restaurant_id: int) -> str:
         lines.append("────────────────────────────────────────")
         lines.append(f"📊 Всего критических дней: {len(critical_dates)} из {len(daily)} ({len(critical_dates)/len(daily)*100:.1f}%)")
         
-        # Анализ типов критических дней
-        holiday_days = 0
-        rainy_days = 0
+        # Анализ типов критических дней — один маскированный срез вместо
+        # прохода по дням
         avg_loss = total_losses / len(critical_dates) if critical_dates else 0
-        
-        for critical_date in critical_dates:
-            day_data = sub[sub["date"] == critical_date].iloc[0] if not sub[sub["date"] == critical_date].empty else None
-            if day_data is not None:
-                if int(day_data.get("is_holiday", 0)) == 1:
-                    holiday_days += 1
-                if float(day_data.get("rain", 0) or 0) >= 2.0:
-                    rainy_days += 1
-        
+        holiday_days = int((crit_hol.astype(int) == 1).sum())
+        rainy_days = int((crit_rain >= 2.0).sum())
+
         lines.append(f"🕌 Праздничных дней: {holiday_days} ({holiday_days/len(critical_dates)*100:.0f}%)")
         lines.append(f"🌧️ Дождливых дней: ~{rainy_days} ({rainy_days/len(critical_dates)*100:.0f}%)")
         lines.append(f"📈 Средние потери на критический день: {_fmt_idr(avg_loss)}")
@@ -943,60 +1135,49 @@ def _section8_critical_days_ml(period: str, restaurant_id: int) -> str:
         lines.append("- Holidays cache — праздники (мусульманские, балийские, индонезийские, международные)")
         lines.append("- ML модель (Random Forest) — SHAP анализ факторов")
         
-        return "\\n".join(lines)
+        return "\n".join(lines)
     
     except Exception as e:
-        return f"8. 🚨 КРИТИЧЕСКИЕ ДНИ\\n════════════════════════════════════════════════════════════════════════\\nОшибка анализа: {str(e)}\\nПроверьте наличие ML модели и данных."
+        return f"8. 🚨 КРИТИЧЕСКИЕ ДНИ (ML)\n════════════════════════════════════════════════════════════════════════\nОшибка анализа: {str(e)}\nПроверьте наличие ML модели и данных."
 def _section9_recommendations(period: str, restaurant_id: int) -> str:
     try:
         # Use SHAP over the whole period to prioritize levers; exclude trivial features
         start_str, end_str = period.split("_")
-        df = pd.read_csv("/workspace/data/merged_dataset.csv", parse_dates=["date"]) if os.path.exists("/workspace/data/merged_dataset.csv") else pd.DataFrame()
-        sub = df[(df.get("restaurant_id") == restaurant_id) & (df.get("date") >= start_str) & (df.get("date") <= end_str)].copy() if not df.empty else pd.DataFrame()
+        sub = _restaurant_period_slice(restaurant_id, start_str, end_str)
         lines = []
         lines.append("9. 🎯 СТРАТЕГИЧЕСКИЕ РЕКОМЕНДАЦИИ")
-        lines.append("—" * 72)
+        lines.append(_DIV)
         if sub.empty:
             lines.append("Нет данных за период.")
             return "\n".join(lines)
 
         # Load model and compute feature importances
-        model, features, background = load_artifacts("/workspace/ml/artifacts")
+        model, features, pre, mdl, explainer = load_explainer("/workspace/ml/artifacts")
         X = sub[features]
-        pre = model.named_steps["pre"]
-        mdl = model.named_steps["model"]
         X_pre = pre.transform(X)
         try:
-            if background is not None and not background.empty:
-                bg_pre = pre.transform(background[features])
-                explainer = shap.TreeExplainer(mdl, data=bg_pre, feature_perturbation="interventional")
-            else:
-                explainer = shap.TreeExplainer(mdl, feature_perturbation="interventional")
-            shap_values = explainer.shap_values(X_pre)
+            shap_values = _shap_matrix(mdl, explainer, X_pre)
         except Exception:
             explainer = shap.TreeExplainer(mdl)
-            shap_values = explainer.shap_values(X_pre)
+            shap_values = _shap_matrix(mdl, explainer, X_pre)
         _, groups = _resolve_preprocessed_feature_groups(pre)
-        import re as _re
-        pat = [_re.compile(r"^orders_count(?!.*conversion).*"), _re.compile(r"^total_sales.*"), _re.compile(r"^restaurant_id$")]
-        def is_excl(n: str) -> bool:
-            return any(p.search(n) for p in pat)
-        abs_sv = np.abs(shap_values)
+        # Средний |SHAP| по группам: одна редукция по колонкам + reduceat
+        # по конкатенированным индексам вместо Python-среза на группу
+        col_means = np.abs(shap_values).mean(axis=0)
+        keys = [f for f, idxs in groups.items() if idxs and not _SECTION9_EXCLUDE_RE.search(f)]
         agg: Dict[str, float] = {}
-        for feat, idxs in groups.items():
-            if is_excl(feat) or not idxs:
-                continue
-            agg[feat] = float(abs_sv[:, idxs].mean())
-        top = sorted(agg.items(), key=lambda x: x[1], reverse=True)[:8]
-
-        # Group by categories
-        cats: Dict[str, float] = {}
-        for f, v in agg.items():
-            c = _categorize_feature(f)
-            cats[c] = cats.get(c, 0.0) + v
-        tot = sum(cats.values()) or 1.0
-        for k in list(cats.keys()):
-            cats[k] = round(100.0 * cats[k] / tot, 1)
+        if keys:
+            sizes = np.array([len(groups[f]) for f in keys])
+            flat_idx = np.concatenate([groups[f] for f in keys])
+            sums = np.add.reduceat(col_means[flat_idx], np.r_[0, np.cumsum(sizes)[:-1]])
+            agg = dict(zip(keys, sums / sizes))
+        agg_s = pd.Series(agg, dtype=float)
+        top = list(agg_s.nlargest(8).items())
+
+        # Group by categories (single vectorized pass instead of per-feature dict loops)
+        cats_s = agg_s.groupby(agg_s.index.map(_categorize_feature)).sum()
+        tot = float(cats_s.sum()) or 1.0
+        cats: Dict[str, float] = (cats_s / tot * 100.0).round(1).to_dict()
 
         lines.append("Приоритеты по факторам (ML):")
         for f, v in top:
@@ -1017,13 +1198,27 @@ def _section9_recommendations(period: str, restaurant_id: int) -> str:
         lines.append("  • Контроль качества и рейтингов: работа с негативом, улучшение времени ожидания")
         return "\n".join(lines)
     except Exception:
-        return "9. 🎯 СТРАТЕГИЧЕСКИЕ РЕКОМЕНДАЦИИ\n" + ("—" * 72) + "\nНе удалось построить рекомендации."
+        return "9. 🎯 СТРАТЕГИЧЕСКИЕ РЕКОМЕНДАЦИИ\n" + _DIV + "\nНе удалось построить рекомендации."
 
 
 def generate_full_report(period: str, restaurant_id: int) -> str:
-    basic = build_basic_report(period, restaurant_id)
-    marketing = build_marketing_report(period, restaurant_id)
-    quality = build_quality_report(period, restaurant_id)
+    # Независимые билдеры упираются в I/O (SQLite, CSV) и C-ядро pandas/SHAP,
+    # которые отпускают GIL — пул потоков даёт ~max(секция) вместо суммы
+    with ThreadPoolExecutor(max_workers=4) as ex:
+        f_basic = ex.submit(build_basic_report, period, restaurant_id)
+        f_marketing = ex.submit(build_marketing_report, period, restaurant_id)
+        f_quality = ex.submit(build_quality_report, period, restaurant_id)
+        f_s3 = ex.submit(_section3_clients, period, restaurant_id)
+        f_s6 = ex.submit(_section6_operations, period, restaurant_id)
+        f_s8 = ex.submit(_section8_critical_days_ml, period, restaurant_id)
+        f_s9 = ex.submit(_section9_recommendations, period, restaurant_id)
+        basic = f_basic.result()
+        marketing = f_marketing.result()
+        quality = f_quality.result()
+        s3_text = f_s3.result()
+        s6_text = f_s6.result()
+        s8_text = f_s8.result()
+        s9_text = f_s9.result()
     finance = basic.get("finance") if isinstance(basic, dict) else None
 
     parts = []
@@ -1039,7 +1234,7 @@ def generate_full_report(period: str, restaurant_id: int) -> str:
     parts.append(_section2_trends(basic))
     parts.append("")
     # Section 3
-    parts.append(_section3_clients(period, restaurant_id))
+    parts.append(s3_text)
     parts.append("")
     # Section 4
     parts.append(_section4_marketing(marketing))
@@ -1049,15 +1244,15 @@ def generate_full_report(period: str, restaurant_id: int) -> str:
         parts.append(_section5_finance(finance))
         parts.append("")
     # Section 6
-    parts.append(_section6_operations(period, restaurant_id))
+    parts.append(s6_text)
     parts.append("")
     # Section 7
     parts.append(_section7_quality(quality))
     parts.append("")
     # Section 8 (ML Critical Days)
-    parts.append(_section8_critical_days_ml(period, restaurant_id))
+    parts.append(s8_text)
     parts.append("")
     # Section 9 (Recommendations)
-    parts.append(_section9_recommendations(period, restaurant_id))
+    parts.append(s9_text)
     parts.append("")
     return "\n".join(parts)
\ No newline at end of file
@@ -3,13 +3,25 @@
 Создает новые таблицы и мигрирует существующие данные
 """
 
+import csv
+import hashlib
+import io
 import os
 import sys
+import json
 import logging
 from datetime import datetime
 
 import psycopg2
+from contextlib import contextmanager
+from psycopg2 import pool as pg_pool
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.extras import execute_values
+
+try:
+    import orjson
+except ImportError:  # опциональное ускорение сериализации
+    orjson = None
 
 sys.path.append('/workspace')
 
@@ -19,6 +31,21 @@ logger = logging.getLogger(__name__)
 
 DB_DSN = os.getenv("DATABASE_URL")
 
+_POOL = None
+
+
+@contextmanager
+def get_conn():
+    """Соединение из общего пула — без TLS/auth-рукопожатия на каждый шаг миграции."""
+    global _POOL
+    if _POOL is None:
+        _POOL = pg_pool.ThreadedConnectionPool(1, 4, DB_DSN)
+    conn = _POOL.getconn()
+    try:
+        yield conn
+    finally:
+        _POOL.putconn(conn)
+
 
 def create_database_schema():
     """Создание схемы БД для работы с живым API"""
@@ -34,28 +61,26 @@ def create_database_schema():
             schema_sql = f.read()
         
         # Выполняем миграцию
-        with psycopg2.connect(DB_DSN) as conn:
+        with get_conn() as conn:
+            old_isolation = conn.isolation_level
             conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
             
             with conn.cursor() as cursor:
                 logger.info("Creating database schema...")
-                
-                # Выполняем SQL по частям (разделяем по CREATE)
-                statements = schema_sql.split(';')
-                
-                for i, statement in enumerate(statements):
-                    statement = statement.strip()
-                    if statement:
-                        try:
-                            cursor.execute(statement)
-                            logger.info(f"Executed statement {i+1}/{len(statements)}")
-                        except Exception as e:
-                            # Некоторые CREATE IF NOT EXISTS могут давать warnings
-                            if "already exists" in str(e).lower():
-                                logger.info(f"Statement {i+1} - object already exists, skipping")
-                            else:
-                                logger.error(f"Error in statement {i+1}: {e}")
-                                logger.error(f"Statement: {statement[:100]}...")
+
+                # Один вызов: psycopg2 исполняет многооператорный SQL целиком
+                # под autocommit. Наивный split(';') ломал $$-тела функций и
+                # строковые литералы и платил round-trip за каждый оператор.
+                try:
+                    cursor.execute(schema_sql)
+                except Exception as e:
+                    if "already exists" in str(e).lower():
+                        logger.info("Schema objects already exist, skipping")
+                    else:
+                        logger.error(f"Error executing schema: {e}")
+                        logger.error(f"Query: {str(cursor.query)[:200]}...")
+                        raise
+            conn.set_isolation_level(old_isolation)
         
         logger.info("✅ Database schema created successfully")
         return True
@@ -79,67 +104,87 @@ def migrate_existing_data():
             return True
         
         sqlite_conn = sqlite3.connect(sqlite_path)
-        
+        sqlite_conn.row_factory = sqlite3.Row
+
+        # Индекс по дате превращает ORDER BY stat_date DESC LIMIT из
+        # полной сортировки таблицы в обход индекса; курсор дальше
+        # стримит страницы без материализации
+        sqlite_conn.execute("CREATE INDEX IF NOT EXISTS ix_grab_stats_stat_date ON grab_stats(stat_date)")
+        sqlite_conn.execute("CREATE INDEX IF NOT EXISTS ix_gojek_stats_stat_date ON gojek_stats(stat_date)")
+
         # Мигрируем рестораны
         logger.info("Migrating restaurants...")
         restaurants_df = pd.read_sql_query("SELECT id, name FROM restaurants", sqlite_conn)
         
-        with psycopg2.connect(DB_DSN) as pg_conn:
+        # Все шаги миграции идут через одно соединение из пула
+        with get_conn() as pg_conn:
             with pg_conn.cursor() as cursor:
-                for _, row in restaurants_df.iterrows():
-                    cursor.execute("""
-                        INSERT INTO restaurant_mapping (restaurant_id, restaurant_name, is_active)
-                        VALUES (%s, %s, %s)
-                        ON CONFLICT (restaurant_name) DO NOTHING
-                    """, (row['id'], row['name'], True))
-                
+                # Один multi-row INSERT вместо round-trip'а на ресторан
+                execute_values(
+                    cursor,
+                    """
+                    INSERT INTO restaurant_mapping (restaurant_id, restaurant_name, is_active)
+                    VALUES %s
+                    ON CONFLICT (restaurant_name) DO NOTHING
+                    """,
+                    [(r.id, r.name, True) for r in restaurants_df.itertuples(index=False)],
+                )
                 pg_conn.commit()
                 logger.info(f"✅ Migrated {len(restaurants_df)} restaurants")
-        
-        # Мигрируем статистику GRAB
-        logger.info("Migrating GRAB stats...")
-        grab_df = pd.read_sql_query("""
-            SELECT 
-                r.name as restaurant_name,
-                g.stat_date,
-                g.sales,
-                g.orders,
-                g.ads_spend,
-                g.ads_sales,
-                g.cancelled_orders,
-                g.rating,
-                g.offline_rate
-            FROM grab_stats g
-            JOIN restaurants r ON g.restaurant_id = r.id
-            ORDER BY g.stat_date DESC
-            LIMIT 10000
-        """, sqlite_conn)
-        
-        _migrate_stats_batch(grab_df, 'grab')
-        
-        # Мигрируем статистику GOJEK  
-        logger.info("Migrating GOJEK stats...")
-        gojek_df = pd.read_sql_query("""
-            SELECT 
-                r.name as restaurant_name,
-                g.stat_date,
-                g.sales,
-                g.orders,
-                g.ads_spend,
-                g.ads_sales,
-                g.cancelled_orders,
-                g.lost_orders,
-                g.rating,
-                g.accepting_time,
-                g.preparation_time,
-                g.delivery_time
-            FROM gojek_stats g
-            JOIN restaurants r ON g.restaurant_id = r.id
-            ORDER BY g.stat_date DESC
-            LIMIT 10000
-        """, sqlite_conn)
-        
-        _migrate_stats_batch(gojek_df, 'gojek')
+
+            # Мигрируем статистику GRAB потоково: курсор SQLite читается
+            # пачками словарей, без DataFrame между курсором и COPY
+            logger.info("Migrating GRAB stats...")
+            grab_sql = """
+                SELECT 
+                    r.name as restaurant_name,
+                    g.stat_date,
+                    g.sales,
+                    g.orders,
+                    g.ads_spend,
+                    g.ads_sales,
+                    g.cancelled_orders,
+                    g.rating,
+                    g.offline_rate
+                FROM grab_stats g
+                JOIN restaurants r ON g.restaurant_id = r.id
+                ORDER BY g.stat_date DESC
+                LIMIT 10000
+            """
+            grab_cur = sqlite_conn.execute(grab_sql)
+            while True:
+                batch = grab_cur.fetchmany(2000)
+                if not batch:
+                    break
+                _migrate_stats_batch([dict(r) for r in batch], 'grab', pg_conn)
+            
+            # Мигрируем статистику GOJEK  
+            logger.info("Migrating GOJEK stats...")
+            gojek_sql = """
+                SELECT 
+                    r.name as restaurant_name,
+                    g.stat_date,
+                    g.sales,
+                    g.orders,
+                    g.ads_spend,
+                    g.ads_sales,
+                    g.cancelled_orders,
+                    g.lost_orders,
+                    g.rating,
+                    g.accepting_time,
+                    g.preparation_time,
+                    g.delivery_time
+                FROM gojek_stats g
+                JOIN restaurants r ON g.restaurant_id = r.id
+                ORDER BY g.stat_date DESC
+                LIMIT 10000
+            """
+            gojek_cur = sqlite_conn.execute(gojek_sql)
+            while True:
+                batch = gojek_cur.fetchmany(2000)
+                if not batch:
+                    break
+                _migrate_stats_batch([dict(r) for r in batch], 'gojek', pg_conn)
         
         sqlite_conn.close()
         
@@ -155,56 +200,97 @@ def migrate_existing_data():
         return False
 
 
-def _migrate_stats_batch(df, source):
-    """Миграция батча статистики"""
-    
-    with psycopg2.connect(DB_DSN) as conn:
-        with conn.cursor() as cursor:
-            
-            for _, row in df.iterrows():
-                # Создаем payload из всех полей
-                payload = row.to_dict()
-                
-                # Удаляем None значения
-                payload = {k: v for k, v in payload.items() if pd.notna(v)}
-                
-                row_hash = _hash_payload(payload)
-                
-                cursor.execute("""
-                    INSERT INTO raw_stats (
-                        restaurant_name, source, stat_date, payload, row_hash,
-                        sales_idr, orders_total, ads_spend_idr, ads_sales_idr,
-                        cancelled_orders, lost_orders, rating_avg, offline_time_min
-                    )
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (restaurant_name, source, stat_date) DO NOTHING
-                """, (
-                    row.get('restaurant_name'),
-                    source,
-                    row.get('stat_date'),
-                    json.dumps(payload, ensure_ascii=False),
-                    row_hash,
-                    row.get('sales', 0),
-                    row.get('orders', 0),
-                    row.get('ads_spend', 0),
-                    row.get('ads_sales', 0),
-                    row.get('cancelled_orders', 0),
-                    row.get('lost_orders', 0),
-                    row.get('rating', 0),
-                    row.get('offline_rate', 0)
-                ))
-            
+_MIGRATE_COLS = (
+    "restaurant_name, source, stat_date, payload, row_hash, "
+    "sales_idr, orders_total, ads_spend_idr, ads_sales_idr, "
+    "cancelled_orders, lost_orders, rating_avg, offline_time_min"
+)
+
+
+_MIGRATE_COLS_STAGED = ", ".join(f"s.{c.strip()}" for c in _MIGRATE_COLS.split(","))
+
+# Размер чанка ограничивает пик памяти (JSON-пейлоады) и окна блокировок
+_MIGRATE_CHUNK_ROWS = 1000
+
+
+def _batch_rows(records, source):
+    # records — словари строк напрямую из курсора SQLite (NULL уже None)
+    rows = []
+    for rec in records:
+        payload = {k: v for k, v in rec.items() if v is not None}
+        # Одна сериализация на строку: байты идут и в колонку payload,
+        # и в хеш — без второго json.dumps внутри _hash_payload
+        serialized = _serialize_payload(payload)
+        rows.append((
+            rec.get('restaurant_name'),
+            source,
+            rec.get('stat_date'),
+            serialized.decode('utf-8'),
+            hashlib.sha256(serialized).hexdigest(),
+            rec.get('sales') or 0,
+            rec.get('orders') or 0,
+            rec.get('ads_spend') or 0,
+            rec.get('ads_sales') or 0,
+            rec.get('cancelled_orders') or 0,
+            rec.get('lost_orders') or 0,
+            rec.get('rating') or 0,
+            rec.get('offline_rate') or 0
+        ))
+    return rows
+
+
+def _migrate_stats_batch(records, source, conn=None):
+    """Миграция батча статистики.
+
+    records — список dict-строк; conn — соединение из пула (по умолчанию своё).
+    """
+
+    if not records:
+        return
+
+    if conn is None:
+        with get_conn() as pooled:
+            _migrate_stats_batch(records, source, pooled)
+        return
+
+    # COPY в staging-таблицу минует extended-query протокол целиком, затем
+    # один INSERT ... SELECT с ON CONFLICT раскладывает чанк в raw_stats.
+    # ON COMMIT DELETE ROWS очищает staging на каждом чанковом коммите;
+    # IF NOT EXISTS — батчи разных источников делят сессию пула.
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS raw_stats_stage (LIKE raw_stats INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+        )
+        for start in range(0, len(records), _MIGRATE_CHUNK_ROWS):
+            chunk = records[start:start + _MIGRATE_CHUNK_ROWS]
+            buf = io.StringIO()
+            csv.writer(buf).writerows(_batch_rows(chunk, source))
+            buf.seek(0)
+            cursor.copy_expert(
+                f"COPY raw_stats_stage ({_MIGRATE_COLS}) FROM STDIN WITH (FORMAT csv)", buf
+            )
+            # Anti-join вместо ON CONFLICT: уникальный индекс не
+            # прощупывается на каждой строке, существующие ключи
+            # отсеиваются одним hash-join'ом
+            cursor.execute(
+                f"INSERT INTO raw_stats ({_MIGRATE_COLS}) "
+                f"SELECT DISTINCT ON (s.restaurant_name, s.source, s.stat_date) {_MIGRATE_COLS_STAGED} "
+                "FROM raw_stats_stage s "
+                "LEFT JOIN raw_stats r USING (restaurant_name, source, stat_date) "
+                "WHERE r.restaurant_name IS NULL"
+            )
             conn.commit()
-            logger.info(f"✅ Migrated {len(df)} {source} records")
+        logger.info(f"✅ Migrated {len(records)} {source} records")
+
 
+def _serialize_payload(obj) -> bytes:
+    """Каноничные байты payload (сортировка ключей) для колонки и хеша.
 
-def _hash_payload(obj):
-    """Создание хеша для идемпотентности"""
-    import hashlib
-    import json
-    return hashlib.sha256(
-        json.dumps(obj, sort_keys=True, ensure_ascii=False).encode("utf-8")
-    ).hexdigest()
+    Компактные separators в фолбэке повторяют байты orjson — хеши не
+    зависят от того, установлен ли он (как в etl/api_client)."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(obj, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
 
 
 def test_api_connection():
@@ -45,24 +45,31 @@ class Restaurant(Base):
 class Sale(Base):
     __tablename__ = "sales"
 
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    restaurant_id = Column(Integer, ForeignKey("restaurants.id"), nullable=False, index=True)
-    date = Column(Date, nullable=False, index=True)
-    platform = Column(Text, nullable=True)
+    # Натуральный ключ (ресторан, дата, платформа): без surrogate id нет
+    # лишнего B-tree и sequence на вставке, а UPSERT бьёт прямо по ключу
+    restaurant_id = Column(Integer, ForeignKey("restaurants.id"), primary_key=True)
+    date = Column(Date, primary_key=True)
+    platform = Column(Text, primary_key=True, default="")
     total_sales = Column(Float, nullable=True)
     orders_count = Column(Integer, nullable=True)
 
+    # Составной индекс покрывает и одноколоночные предикаты по
+    # restaurant_id; INCLUDE даёт index-only scan по метрикам
     __table_args__ = (
-        Index("ix_sales_restaurant_date", "restaurant_id", "date"),
+        Index(
+            "ix_sales_restaurant_date",
+            "restaurant_id",
+            "date",
+            postgresql_include=["total_sales", "orders_count"],
+        ),
     )
 
 
 class Operation(Base):
     __tablename__ = "operations"
 
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    restaurant_id = Column(Integer, ForeignKey("restaurants.id"), nullable=False, index=True)
-    date = Column(Date, nullable=False, index=True)
+    restaurant_id = Column(Integer, ForeignKey("restaurants.id"), primary_key=True)
+    date = Column(Date, primary_key=True)
     accepting_time = Column(Float, nullable=True)
     delivery_time = Column(Float, nullable=True)
     preparation_time = Column(Float, nullable=True)
@@ -70,39 +77,52 @@ class Operation(Base):
     repeat_customers = Column(Integer, nullable=True)
 
     __table_args__ = (
-        Index("ix_operations_restaurant_date", "restaurant_id", "date"),
+        Index(
+            "ix_operations_restaurant_date",
+            "restaurant_id",
+            "date",
+            postgresql_include=["accepting_time", "delivery_time", "preparation_time", "rating"],
+        ),
     )
 
 
 class Marketing(Base):
     __tablename__ = "marketing"
 
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    restaurant_id = Column(Integer, ForeignKey("restaurants.id"), nullable=False, index=True)
-    date = Column(Date, nullable=False, index=True)
+    restaurant_id = Column(Integer, ForeignKey("restaurants.id"), primary_key=True)
+    date = Column(Date, primary_key=True)
     ads_spend = Column(Float, nullable=True)
     roas = Column(Float, nullable=True)
     impressions = Column(Integer, nullable=True)
     clicks = Column(Integer, nullable=True)
 
     __table_args__ = (
-        Index("ix_marketing_restaurant_date", "restaurant_id", "date"),
+        Index(
+            "ix_marketing_restaurant_date",
+            "restaurant_id",
+            "date",
+            postgresql_include=["ads_spend", "roas", "impressions", "clicks"],
+        ),
     )
 
 
 class Weather(Base):
     __tablename__ = "weather"
 
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    restaurant_id = Column(Integer, ForeignKey("restaurants.id"), nullable=False, index=True)
-    date = Column(Date, nullable=False, index=True)
+    restaurant_id = Column(Integer, ForeignKey("restaurants.id"), primary_key=True)
+    date = Column(Date, primary_key=True)
     temp = Column(Float, nullable=True)
     rain = Column(Float, nullable=True)
     wind = Column(Float, nullable=True)
     humidity = Column(Float, nullable=True)
 
     __table_args__ = (
-        Index("ix_weather_restaurant_date", "restaurant_id", "date"),
+        Index(
+            "ix_weather_restaurant_date",
+            "restaurant_id",
+            "date",
+            postgresql_include=["temp", "rain", "wind", "humidity"],
+        ),
     )
 
 
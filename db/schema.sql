@@ -44,57 +44,51 @@ CREATE INDEX IF NOT EXISTS idx_raw_stats_restaurant ON raw_stats(restaurant_name
 CREATE INDEX IF NOT EXISTS idx_raw_stats_source_date ON raw_stats(source, stat_date);
 CREATE INDEX IF NOT EXISTS idx_raw_stats_updated ON raw_stats(updated_at);
 
--- Материализованная витрина для ML и отчетов
-CREATE MATERIALIZED VIEW IF NOT EXISTS mv_daily_metrics AS
-SELECT
-    rm.restaurant_id,
-    rs.restaurant_name,
-    rs.source,
-    rs.stat_date,
-    
+-- Витрина для ML и отчетов: обычная таблица вместо матвью.
+-- Поддерживается инкрементально тем же UPSERT'ом, который пишет raw_stats
+-- (etl/api_client.upsert_stats_data) — O(изменённых строк) вместо полного
+-- REFRESH по всей истории.
+
+-- Унаследованная матвью уступает место таблице
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_matviews WHERE matviewname = 'mv_daily_metrics') THEN
+        EXECUTE 'DROP MATERIALIZED VIEW mv_daily_metrics CASCADE';
+    END IF;
+END $$;
+
+CREATE TABLE IF NOT EXISTS daily_metrics (
+    restaurant_id INT,
+    restaurant_name TEXT NOT NULL,
+    source TEXT NOT NULL,
+    stat_date DATE NOT NULL,
+
     -- Основные метрики
-    COALESCE(rs.sales_idr, (rs.payload->>'sales')::BIGINT, 0) AS sales,
-    COALESCE(rs.orders_total, (rs.payload->>'orders')::INT, 0) AS orders,
-    COALESCE(rs.ads_spend_idr, (rs.payload->>'ads_spend')::BIGINT, 0) AS ads_spend,
-    COALESCE(rs.ads_sales_idr, (rs.payload->>'ads_sales')::BIGINT, 0) AS ads_sales,
-    
+    sales BIGINT,
+    orders INT,
+    ads_spend BIGINT,
+    ads_sales BIGINT,
+
     -- Операционные метрики
-    COALESCE(rs.cancelled_orders, (rs.payload->>'cancelled_orders')::INT, 0) AS cancelled_orders,
-    COALESCE(rs.lost_orders, (rs.payload->>'lost_orders')::INT, 0) AS lost_orders,
-    COALESCE(rs.rating_avg, (rs.payload->>'rating')::REAL, 0) AS rating,
-    
-    -- Временные метрики (приводим к минутам)
-    COALESCE(rs.prep_time_min, 
-        CASE 
-            WHEN rs.payload->>'preparation_time' ~ '^[0-9]+:[0-9]+:[0-9]+$' THEN
-                EXTRACT(HOUR FROM (rs.payload->>'preparation_time')::TIME) * 60 + 
-                EXTRACT(MINUTE FROM (rs.payload->>'preparation_time')::TIME)
-            ELSE (rs.payload->>'preparation_time')::REAL
-        END
-    ) AS preparation_time_min,
-    
-    COALESCE(rs.delivery_time_min,
-        CASE 
-            WHEN rs.payload->>'delivery_time' ~ '^[0-9]+:[0-9]+:[0-9]+$' THEN
-                EXTRACT(HOUR FROM (rs.payload->>'delivery_time')::TIME) * 60 + 
-                EXTRACT(MINUTE FROM (rs.payload->>'delivery_time')::TIME)
-            ELSE (rs.payload->>'delivery_time')::REAL
-        END
-    ) AS delivery_time_min,
-    
-    COALESCE(rs.offline_time_min, (rs.payload->>'offline_rate')::REAL, 0) AS offline_rate_min,
-    
+    cancelled_orders INT,
+    lost_orders INT,
+    rating REAL,
+
+    -- Временные метрики (в минутах)
+    preparation_time_min REAL,
+    delivery_time_min REAL,
+    offline_rate_min REAL,
+
     -- Полный payload для расширенного анализа
-    rs.payload,
-    rs.updated_at
-    
-FROM raw_stats rs
-LEFT JOIN restaurant_mapping rm ON rs.restaurant_name = rm.restaurant_name
-WHERE rm.is_active IS TRUE OR rm.is_active IS NULL;
+    payload JSONB,
+    updated_at TIMESTAMP,
+
+    PRIMARY KEY (restaurant_name, source, stat_date)
+);
 
 -- Индексы для витрины
-CREATE INDEX IF NOT EXISTS idx_mv_daily_restaurant_date ON mv_daily_metrics(restaurant_id, stat_date);
-CREATE INDEX IF NOT EXISTS idx_mv_daily_source_date ON mv_daily_metrics(source, stat_date);
+CREATE INDEX IF NOT EXISTS idx_daily_metrics_restaurant_date ON daily_metrics(restaurant_id, stat_date);
+CREATE INDEX IF NOT EXISTS idx_daily_metrics_source_date ON daily_metrics(source, stat_date);
 
 -- Очередь ML заданий
 CREATE TABLE IF NOT EXISTS ml_jobs (
@@ -111,31 +105,78 @@ CREATE TABLE IF NOT EXISTS ml_jobs (
 
 CREATE INDEX IF NOT EXISTS idx_ml_jobs_status ON ml_jobs(status, created_at);
 
--- Функция для автоматического обновления витрины
-CREATE OR REPLACE FUNCTION refresh_daily_metrics() 
+-- Полная пересборка витрины (миграции, ручное восстановление);
+-- штатный путь — инкрементальный UPSERT из etl/api_client
+CREATE OR REPLACE FUNCTION refresh_daily_metrics()
 RETURNS VOID AS $$
 BEGIN
-    REFRESH MATERIALIZED VIEW CONCURRENTLY mv_daily_metrics;
-END;
-$$ LANGUAGE plpgsql;
+    INSERT INTO daily_metrics (
+        restaurant_id, restaurant_name, source, stat_date,
+        sales, orders, ads_spend, ads_sales,
+        cancelled_orders, lost_orders, rating,
+        preparation_time_min, delivery_time_min, offline_rate_min,
+        payload, updated_at
+    )
+    SELECT
+        rm.restaurant_id,
+        rs.restaurant_name,
+        rs.source,
+        rs.stat_date,
 
--- Триггер для автообновления витрины при изменении raw_stats
-CREATE OR REPLACE FUNCTION trigger_refresh_metrics()
-RETURNS TRIGGER AS $$
-BEGIN
-    -- Добавляем задачу на обновление витрины (не сразу, чтобы не блокировать)
-    INSERT INTO ml_jobs(job_type, payload) 
-    VALUES ('refresh_metrics', json_build_object('trigger_time', now()));
-    RETURN NULL;
+        COALESCE(rs.sales_idr, (rs.payload->>'sales')::BIGINT, 0),
+        COALESCE(rs.orders_total, (rs.payload->>'orders')::INT, 0),
+        COALESCE(rs.ads_spend_idr, (rs.payload->>'ads_spend')::BIGINT, 0),
+        COALESCE(rs.ads_sales_idr, (rs.payload->>'ads_sales')::BIGINT, 0),
+
+        COALESCE(rs.cancelled_orders, (rs.payload->>'cancelled_orders')::INT, 0),
+        COALESCE(rs.lost_orders, (rs.payload->>'lost_orders')::INT, 0),
+        COALESCE(rs.rating_avg, (rs.payload->>'rating')::REAL, 0),
+
+        COALESCE(rs.prep_time_min,
+            CASE
+                WHEN rs.payload->>'preparation_time' ~ '^[0-9]+:[0-9]+:[0-9]+$' THEN
+                    EXTRACT(HOUR FROM (rs.payload->>'preparation_time')::TIME) * 60 +
+                    EXTRACT(MINUTE FROM (rs.payload->>'preparation_time')::TIME)
+                ELSE (rs.payload->>'preparation_time')::REAL
+            END
+        ),
+        COALESCE(rs.delivery_time_min,
+            CASE
+                WHEN rs.payload->>'delivery_time' ~ '^[0-9]+:[0-9]+:[0-9]+$' THEN
+                    EXTRACT(HOUR FROM (rs.payload->>'delivery_time')::TIME) * 60 +
+                    EXTRACT(MINUTE FROM (rs.payload->>'delivery_time')::TIME)
+                ELSE (rs.payload->>'delivery_time')::REAL
+            END
+        ),
+        COALESCE(rs.offline_time_min, (rs.payload->>'offline_rate')::REAL, 0),
+
+        rs.payload,
+        rs.updated_at
+
+    FROM raw_stats rs
+    LEFT JOIN restaurant_mapping rm ON rs.restaurant_name = rm.restaurant_name
+    WHERE rm.is_active IS TRUE OR rm.is_active IS NULL
+    ON CONFLICT (restaurant_name, source, stat_date) DO UPDATE SET
+        restaurant_id = EXCLUDED.restaurant_id,
+        sales = EXCLUDED.sales,
+        orders = EXCLUDED.orders,
+        ads_spend = EXCLUDED.ads_spend,
+        ads_sales = EXCLUDED.ads_sales,
+        cancelled_orders = EXCLUDED.cancelled_orders,
+        lost_orders = EXCLUDED.lost_orders,
+        rating = EXCLUDED.rating,
+        preparation_time_min = EXCLUDED.preparation_time_min,
+        delivery_time_min = EXCLUDED.delivery_time_min,
+        offline_rate_min = EXCLUDED.offline_rate_min,
+        payload = EXCLUDED.payload,
+        updated_at = EXCLUDED.updated_at;
 END;
 $$ LANGUAGE plpgsql;
 
--- Создаем триггер (опционально, для автообновления)
+-- Витрина сопровождается синхронно в транзакции апсерта — триггерная
+-- очередь refresh_metrics больше не нужна
 DROP TRIGGER IF EXISTS trigger_raw_stats_refresh ON raw_stats;
-CREATE TRIGGER trigger_raw_stats_refresh
-    AFTER INSERT OR UPDATE ON raw_stats
-    FOR EACH STATEMENT
-    EXECUTE FUNCTION trigger_refresh_metrics();
+DROP FUNCTION IF EXISTS trigger_refresh_metrics();
 
 -- Вью для проверки качества данных (data gaps)
 CREATE OR REPLACE VIEW data_quality_check AS
@@ -151,7 +192,7 @@ FROM (
         stat_date,
         SUM(CASE WHEN source = 'grab' THEN sales END) as grab_sales,
         SUM(CASE WHEN source = 'gojek' THEN sales END) as gojek_sales
-    FROM mv_daily_metrics 
+    FROM daily_metrics 
     GROUP BY restaurant_name, stat_date
 ) t
 WHERE grab_issue IS NOT NULL OR gojek_issue IS NOT NULL OR sales_issue IS NOT NULL;
\ No newline at end of file
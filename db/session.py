@@ -4,6 +4,7 @@ from __future__ import annotations
 
 import os
 from contextlib import contextmanager
+from functools import lru_cache
 from typing import Iterator
 
 from sqlalchemy import create_engine
@@ -25,8 +26,24 @@ def get_postgres_dsn() -> str:
     return f"postgresql+psycopg2://{user}:{password}@{host}:{port}/{db}"
 
 
+@lru_cache(maxsize=2)
 def get_engine(echo: bool = False) -> Engine:
-    return create_engine(get_postgres_dsn(), echo=echo, future=True)
+    """Process-wide engine: every caller shares one connection pool
+    instead of constructing a fresh engine (and pool) per call."""
+    return create_engine(
+        get_postgres_dsn(),
+        echo=echo,
+        future=True,
+        pool_size=10,
+        max_overflow=20,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+        # Bulk executemany becomes multi-row VALUES (and psycopg2
+        # execute_batch for statements VALUES can't cover)
+        executemany_mode="values_plus_batch",
+        insertmanyvalues_page_size=1000,
+        executemany_batch_page_size=500,
+    )
 
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=get_engine())
@@ -3,8 +3,12 @@ API клиент для получения статистики ресторан
 Основано на спецификации: GET /api/v1/getRestaurantStats
 """
 
+import csv
+import io
 import os
+import random
 import time
+import threading
 import hashlib
 import json
 import logging
@@ -13,7 +17,17 @@ from typing import Dict, Any, Optional, List, Iterable
 
 import requests
 import psycopg2
-from psycopg2.extras import execute_values, RealDictCursor
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:  # опциональное ускорение сериализации
+    orjson = None
+
+from contextlib import contextmanager
+from functools import lru_cache
+from psycopg2 import pool as pg_pool
+from psycopg2.extras import Json, RealDictCursor
 
 # Конфигурация
 API_BASE = os.getenv("STATS_API_BASE", "http://5.187.7.140:3000")
@@ -34,34 +48,83 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def _serialize_payload(obj: Any) -> bytes:
+    """Каноничные байты payload: одна сериализация кормит и колонку, и хеш.
+
+    orjson пишет компактный JSON (сортировка ключей, без пробелов) сразу
+    в байты; stdlib-фолбэк использует те же separators, чтобы хеши
+    совпадали между окружениями с orjson и без него."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(obj, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
 def _hash_payload(obj: Any) -> str:
     """Создание хеша для идемпотентности"""
-    return hashlib.sha256(
-        json.dumps(obj, sort_keys=True, ensure_ascii=False).encode("utf-8")
-    ).hexdigest()
+    return hashlib.sha256(_serialize_payload(obj)).hexdigest()
+
+
+# Одна сессия на модуль: keep-alive и пул сокетов вместо TCP(+TLS)
+# рукопожатия на каждый чанковый запрос; ретраи остаются нашими
+_SESSION = requests.Session()
+_HTTP_ADAPTER = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=0)
+_SESSION.mount("http://", _HTTP_ADAPTER)
+_SESSION.mount("https://", _HTTP_ADAPTER)
+
+
+# Ретраим только транзиентные ответы; ошибки программирования/протокола
+# не тратят попытки
+_RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+_BACKOFF_CAP = 30.0  # секунд
+
+# Кэш условных запросов: (ресторан, источник, период) -> (ETag,
+# Last-Modified, разобранный ответ)
+_HTTP_CACHE: Dict = {}
+_HTTP_CACHE_MAX = 512
+_HTTP_CACHE_LOCK = threading.Lock()
 
 
-def _make_request(path: str, params: Dict[str, Any]) -> Dict[str, Any]:
-    """Выполнение HTTP запроса с ретраями"""
-    url = f"{API_BASE}{path}"
+@lru_cache(maxsize=8)
+def _endpoint_url(base: str, path: str) -> str:
+    """URL эндпоинта собирается один раз на (base, path)."""
+    return f"{base}{path}"
+
+
+def _make_request(path: str, params: Dict[str, Any], headers: Optional[Dict[str, str]] = None):
+    """Выполнение HTTP запроса с ретраями.
+
+    Возвращает (json-ответ, заголовки ответа); (None, заголовки) на
+    304 Not Modified при условных заголовках."""
+    url = _endpoint_url(API_BASE, path)
     last_exception = None
-    
+
     for attempt in range(RETRIES):
         try:
             logger.info(f"API request attempt {attempt + 1}: {url} with params {params}")
-            response = requests.get(url, params=params, timeout=TIMEOUT)
+            response = _SESSION.get(url, params=params, timeout=TIMEOUT, headers=headers)
+            if response.status_code == 304:
+                logger.info("API 304 Not Modified — тело не передавалось")
+                return None, response.headers
             response.raise_for_status()
-            
+
             result = response.json()
             logger.info(f"API success: {len(result.get('data', []))} records received")
-            return result
-            
-        except Exception as e:
+            return result, response.headers
+
+        except requests.exceptions.HTTPError as e:
+            status = e.response.status_code if e.response is not None else None
+            if status not in _RETRYABLE_STATUS:
+                raise
             last_exception = e
-            wait_time = 1.5 ** (attempt + 1)  # Экспоненциальная пауза
-            logger.warning(f"API request failed (attempt {attempt + 1}): {e}. Retrying in {wait_time:.1f}s")
-            time.sleep(wait_time)
-    
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            last_exception = e
+
+        # Экспоненциальная пауза с джиттером: параллельные клиенты не
+        # ресинхронизируются на ретраях (thundering herd)
+        wait_time = min((1.5 ** (attempt + 1)) * (1 + random.uniform(0, 0.5)), _BACKOFF_CAP)
+        logger.warning(f"API request failed (attempt {attempt + 1}): {last_exception}. Retrying in {wait_time:.1f}s")
+        time.sleep(wait_time)
+
     raise RuntimeError(f"API request failed after {RETRIES} retries: {last_exception}")
 
 
@@ -84,34 +147,85 @@ def fetch_restaurant_stats(restaurant_name: str, source: str, start_date: date,
         "start_date": start_date.isoformat(),
         "end_date": end_date.isoformat(),
     }
-    
-    return _make_request("/api/v1/getRestaurantStats", params)
 
+    # Условный запрос: для неизменившихся чанков сервер отвечает 304 и
+    # тело (и его JSON-декод) не оплачиваются вовсе
+    cache_key = (restaurant_name, source, params["start_date"], params["end_date"])
+    cond_headers = {}
+    with _HTTP_CACHE_LOCK:
+        cached = _HTTP_CACHE.get(cache_key)
+    if cached:
+        etag, last_modified, _ = cached
+        if etag:
+            cond_headers["If-None-Match"] = etag
+        if last_modified:
+            cond_headers["If-Modified-Since"] = last_modified
+
+    result, resp_headers = _make_request("/api/v1/getRestaurantStats", params, headers=cond_headers or None)
+
+    if result is None:
+        if cached:
+            return cached[2]
+        # 304 без нашего кэша — отдаём пустой чанк, синк его пропустит
+        return {"data": [], "restaurant_name": restaurant_name, "source": source}
+
+    etag = resp_headers.get("ETag")
+    last_modified = resp_headers.get("Last-Modified")
+    if etag or last_modified:
+        with _HTTP_CACHE_LOCK:
+            if len(_HTTP_CACHE) >= _HTTP_CACHE_MAX:
+                _HTTP_CACHE.clear()
+            _HTTP_CACHE[cache_key] = (etag, last_modified, result)
+    return result
+
+
+_POOL = None
 
+
+@contextmanager
 def _get_db_connection():
-    """Создание подключения к PostgreSQL"""
+    """Подключение к PostgreSQL из общего пула.
+
+    Сохраняет семантику `with psycopg2.connect(...)`: commit при успехе,
+    rollback при исключении — но вместо TCP+TLS+auth на каждый вызов
+    соединение берётся из пула и возвращается туда же."""
     if not DB_DSN:
         raise RuntimeError("DATABASE_URL environment variable is not set")
-    
-    return psycopg2.connect(DB_DSN)
+
+    global _POOL
+    if _POOL is None:
+        _POOL = pg_pool.ThreadedConnectionPool(1, 8, DB_DSN)
+    conn = _POOL.getconn()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        _POOL.putconn(conn)
 
 
 def _parse_time_field(time_value) -> Optional[float]:
     """Парсинг временных полей в минуты"""
     if not time_value:
         return None
-    
-    try:
-        if isinstance(time_value, str) and ':' in time_value:
-            # Формат HH:MM:SS
-            parts = time_value.split(':')
-            hours = int(parts[0])
-            minutes = int(parts[1])
-            return hours * 60 + minutes
-        else:
-            # Числовое значение
+
+    if isinstance(time_value, str):
+        # Формат HH:MM[:SS]: partition делает проверку и срез одним C-вызовом
+        hours, sep, rest = time_value.partition(':')
+        try:
+            if sep:
+                minutes, _, _ = rest.partition(':')
+                return int(hours) * 60 + int(minutes)
             return float(time_value)
-    except:
+        except ValueError:
+            return None
+
+    # Числовое значение
+    try:
+        return float(time_value)
+    except (TypeError, ValueError):
         return None
 
 
@@ -131,53 +245,67 @@ def _normalize_api_data(api_response: Dict[str, Any]) -> List[Dict[str, Any]]:
     
     normalized_rows = []
     
+    append = normalized_rows.append
     for record in data:
+        # Один bound-method на запись вместо ~15 разыменований record.get
+        get = record.get
+
         # Извлекаем дату
-        stat_date = record.get("stat_date") or record.get("date")
+        stat_date = get("stat_date") or get("date")
         if not stat_date:
             logger.warning(f"Skipping record without date: {record}")
             continue
-        
-        # Нормализуем основные поля
-        normalized_record = {
+
+        # Нормализуем основные поля. payload сериализуется один раз —
+        # эти же байты дают row_hash, второго json.dumps при записи нет
+        payload_bytes = _serialize_payload(record)
+        append({
             "restaurant_name": restaurant_name,
             "source": source,
             "stat_date": stat_date,
-            "payload": record,
-            "row_hash": _hash_payload(record),
-            
+            "payload_json": payload_bytes.decode("utf-8"),
+            "row_hash": hashlib.sha256(payload_bytes).hexdigest(),
+
             # Основные метрики
-            "sales_idr": record.get("sales", 0),
-            "orders_total": record.get("orders", 0),
-            "ads_spend_idr": record.get("ads_spend", 0),
-            "ads_sales_idr": record.get("ads_sales", 0),
-            "cancelled_orders": record.get("cancelled_orders", 0),
-            "lost_orders": record.get("lost_orders", 0),
-            "rating_avg": record.get("rating", 0),
-            
+            "sales_idr": get("sales", 0),
+            "orders_total": get("orders", 0),
+            "ads_spend_idr": get("ads_spend", 0),
+            "ads_sales_idr": get("ads_sales", 0),
+            "cancelled_orders": get("cancelled_orders", 0),
+            "lost_orders": get("lost_orders", 0),
+            "rating_avg": get("rating", 0),
+
             # Временные метрики (приводим к минутам)
-            "prep_time_min": _parse_time_field(record.get("preparation_time")),
-            "confirm_time_min": _parse_time_field(record.get("accepting_time")),
-            "delivery_time_min": _parse_time_field(record.get("delivery_time")),
-            "offline_time_min": record.get("offline_rate", 0),
-        }
-        
-        normalized_rows.append(normalized_record)
+            "prep_time_min": _parse_time_field(get("preparation_time")),
+            "confirm_time_min": _parse_time_field(get("accepting_time")),
+            "delivery_time_min": _parse_time_field(get("delivery_time")),
+            "offline_time_min": get("offline_rate", 0),
+        })
     
     logger.info(f"Normalized {len(normalized_rows)} records for {restaurant_name} ({source})")
     return normalized_rows
 
 
+# Известные рестораны процесса: существование, подтверждённое один раз,
+# больше не гоняет SELECT/INSERT в БД
+_KNOWN_RESTAURANT_IDS: Dict[str, int] = {}
+_KNOWN_RESTAURANTS_LOCK = threading.Lock()
+
+
 def ensure_restaurant_exists(restaurant_name: str) -> int:
     """
     Автоматически добавляет новый ресторан в restaurant_mapping если его нет
-    
+
     Args:
         restaurant_name: Название ресторана
-    
+
     Returns:
         restaurant_id (новый или существующий)
     """
+    cached_id = _KNOWN_RESTAURANT_IDS.get(restaurant_name)
+    if cached_id is not None:
+        return cached_id
+
     with _get_db_connection() as conn:
         with conn.cursor() as cursor:
             # Проверяем, существует ли ресторан
@@ -186,8 +314,10 @@ def ensure_restaurant_exists(restaurant_name: str) -> int:
                 (restaurant_name,)
             )
             result = cursor.fetchone()
-            
+
             if result:
+                with _KNOWN_RESTAURANTS_LOCK:
+                    _KNOWN_RESTAURANT_IDS[restaurant_name] = result[0]
                 return result[0]
             
             # Добавляем новый ресторан
@@ -200,10 +330,103 @@ def ensure_restaurant_exists(restaurant_name: str) -> int:
                 (restaurant_name,)
             )
             new_id = cursor.fetchone()[0]
+            with _KNOWN_RESTAURANTS_LOCK:
+                _KNOWN_RESTAURANT_IDS[restaurant_name] = new_id
             logger.info(f"🆕 Автоматически добавлен новый ресторан: {restaurant_name} (ID: {new_id})")
             return new_id
 
 
+_RAW_STATS_COLS = (
+    "restaurant_name, source, stat_date, payload, row_hash, "
+    "sales_idr, orders_total, ads_spend_idr, ads_sales_idr, "
+    "cancelled_orders, lost_orders, rating_avg, "
+    "prep_time_min, confirm_time_min, delivery_time_min, offline_time_min"
+)
+
+# Инкрементальное сопровождение витрины daily_metrics: пересчитываются
+# только ключи, прошедшие через staging, в той же транзакции
+_DAILY_METRICS_FROM_STAGE_SQL = """
+    INSERT INTO daily_metrics (
+        restaurant_id, restaurant_name, source, stat_date,
+        sales, orders, ads_spend, ads_sales,
+        cancelled_orders, lost_orders, rating,
+        preparation_time_min, delivery_time_min, offline_rate_min,
+        payload, updated_at
+    )
+    SELECT
+        rm.restaurant_id,
+        rs.restaurant_name,
+        rs.source,
+        rs.stat_date,
+        COALESCE(rs.sales_idr, (rs.payload->>'sales')::BIGINT, 0),
+        COALESCE(rs.orders_total, (rs.payload->>'orders')::INT, 0),
+        COALESCE(rs.ads_spend_idr, (rs.payload->>'ads_spend')::BIGINT, 0),
+        COALESCE(rs.ads_sales_idr, (rs.payload->>'ads_sales')::BIGINT, 0),
+        COALESCE(rs.cancelled_orders, (rs.payload->>'cancelled_orders')::INT, 0),
+        COALESCE(rs.lost_orders, (rs.payload->>'lost_orders')::INT, 0),
+        COALESCE(rs.rating_avg, (rs.payload->>'rating')::REAL, 0),
+        COALESCE(rs.prep_time_min,
+            CASE
+                WHEN rs.payload->>'preparation_time' ~ '^[0-9]+:[0-9]+:[0-9]+$' THEN
+                    EXTRACT(HOUR FROM (rs.payload->>'preparation_time')::TIME) * 60 +
+                    EXTRACT(MINUTE FROM (rs.payload->>'preparation_time')::TIME)
+                ELSE (rs.payload->>'preparation_time')::REAL
+            END
+        ),
+        COALESCE(rs.delivery_time_min,
+            CASE
+                WHEN rs.payload->>'delivery_time' ~ '^[0-9]+:[0-9]+:[0-9]+$' THEN
+                    EXTRACT(HOUR FROM (rs.payload->>'delivery_time')::TIME) * 60 +
+                    EXTRACT(MINUTE FROM (rs.payload->>'delivery_time')::TIME)
+                ELSE (rs.payload->>'delivery_time')::REAL
+            END
+        ),
+        COALESCE(rs.offline_time_min, (rs.payload->>'offline_rate')::REAL, 0),
+        rs.payload,
+        rs.updated_at
+    FROM raw_stats rs
+    JOIN raw_stats_stage s USING (restaurant_name, source, stat_date)
+    LEFT JOIN restaurant_mapping rm ON rs.restaurant_name = rm.restaurant_name
+    WHERE rm.is_active IS TRUE OR rm.is_active IS NULL
+    ON CONFLICT (restaurant_name, source, stat_date) DO UPDATE SET
+        restaurant_id = EXCLUDED.restaurant_id,
+        sales = EXCLUDED.sales,
+        orders = EXCLUDED.orders,
+        ads_spend = EXCLUDED.ads_spend,
+        ads_sales = EXCLUDED.ads_sales,
+        cancelled_orders = EXCLUDED.cancelled_orders,
+        lost_orders = EXCLUDED.lost_orders,
+        rating = EXCLUDED.rating,
+        preparation_time_min = EXCLUDED.preparation_time_min,
+        delivery_time_min = EXCLUDED.delivery_time_min,
+        offline_rate_min = EXCLUDED.offline_rate_min,
+        payload = EXCLUDED.payload,
+        updated_at = EXCLUDED.updated_at
+"""
+
+_UPSERT_FROM_STAGE_SQL = f"""
+    INSERT INTO raw_stats ({_RAW_STATS_COLS})
+    SELECT {_RAW_STATS_COLS} FROM raw_stats_stage
+    ON CONFLICT (restaurant_name, source, stat_date)
+    DO UPDATE SET
+        payload = EXCLUDED.payload,
+        row_hash = EXCLUDED.row_hash,
+        sales_idr = EXCLUDED.sales_idr,
+        orders_total = EXCLUDED.orders_total,
+        ads_spend_idr = EXCLUDED.ads_spend_idr,
+        ads_sales_idr = EXCLUDED.ads_sales_idr,
+        cancelled_orders = EXCLUDED.cancelled_orders,
+        lost_orders = EXCLUDED.lost_orders,
+        rating_avg = EXCLUDED.rating_avg,
+        prep_time_min = EXCLUDED.prep_time_min,
+        confirm_time_min = EXCLUDED.confirm_time_min,
+        delivery_time_min = EXCLUDED.delivery_time_min,
+        offline_time_min = EXCLUDED.offline_time_min,
+        updated_at = now()
+    WHERE raw_stats.row_hash <> EXCLUDED.row_hash
+"""
+
+
 def upsert_stats_data(rows: List[Dict[str, Any]]) -> int:
     """
     UPSERT данных в raw_stats с проверкой изменений по хешу
@@ -217,49 +440,58 @@ def upsert_stats_data(rows: List[Dict[str, Any]]) -> int:
     """
     if not rows:
         return 0
-    
-    # Автоматически добавляем новые рестораны
+
     unique_restaurants = set(row["restaurant_name"] for row in rows)
-    for restaurant_name in unique_restaurants:
-        ensure_restaurant_exists(restaurant_name)
-    
-    upsert_sql = """
-        INSERT INTO raw_stats (
-            restaurant_name, source, stat_date, payload, row_hash,
-            sales_idr, orders_total, ads_spend_idr, ads_sales_idr,
-            cancelled_orders, lost_orders, rating_avg,
-            prep_time_min, confirm_time_min, delivery_time_min, offline_time_min
-        )
-        VALUES %s
-        ON CONFLICT (restaurant_name, source, stat_date) 
-        DO UPDATE SET
-            payload = EXCLUDED.payload,
-            row_hash = EXCLUDED.row_hash,
-            sales_idr = EXCLUDED.sales_idr,
-            orders_total = EXCLUDED.orders_total,
-            ads_spend_idr = EXCLUDED.ads_spend_idr,
-            ads_sales_idr = EXCLUDED.ads_sales_idr,
-            cancelled_orders = EXCLUDED.cancelled_orders,
-            lost_orders = EXCLUDED.lost_orders,
-            rating_avg = EXCLUDED.rating_avg,
-            prep_time_min = EXCLUDED.prep_time_min,
-            confirm_time_min = EXCLUDED.confirm_time_min,
-            delivery_time_min = EXCLUDED.delivery_time_min,
-            offline_time_min = EXCLUDED.offline_time_min,
-            updated_at = now()
-        WHERE raw_stats.row_hash <> EXCLUDED.row_hash
-    """
-    
+
     with _get_db_connection() as conn:
         with conn.cursor() as cursor:
+            # Автоматически добавляем новые рестораны одним запросом на том же
+            # курсоре; имена, уже подтверждённые этим процессом, не едут в БД
+            with _KNOWN_RESTAURANTS_LOCK:
+                new_names = sorted(n for n in unique_restaurants if n not in _KNOWN_RESTAURANT_IDS)
+            if new_names:
+                cursor.execute(
+                    "INSERT INTO restaurant_mapping (restaurant_name, is_active, created_at) "
+                    "SELECT unnest(%s::text[]), TRUE, now() "
+                    "ON CONFLICT (restaurant_name) DO NOTHING",
+                    (new_names,)
+                )
+
+            # Клиентская предпроверка хешей: строки, чей row_hash уже лежит в
+            # raw_stats, не сериализуются в CSV и вообще не едут по сети
+            date_groups: Dict = {}
+            for row in rows:
+                date_groups.setdefault((row["restaurant_name"], row["source"]), []).append(row["stat_date"])
+            known_hashes: Dict = {}
+            for (rest_name, rest_source), dates in date_groups.items():
+                cursor.execute(
+                    "SELECT stat_date, row_hash FROM raw_stats "
+                    "WHERE restaurant_name = %s AND source = %s AND stat_date = ANY(%s::date[])",
+                    (rest_name, rest_source, dates)
+                )
+                for d, h in cursor.fetchall():
+                    known_hashes[(rest_name, rest_source, str(d))] = h
+
+            fresh_rows = [
+                row for row in rows
+                if known_hashes.get((row["restaurant_name"], row["source"], str(row["stat_date"]))) != row["row_hash"]
+            ]
+            skipped = len(rows) - len(fresh_rows)
+            if skipped:
+                logger.info(f"Skipped {skipped} unchanged rows (hash match)")
+            if not fresh_rows:
+                conn.commit()
+                logger.info("UPSERT completed: 0 records updated")
+                return 0
+
             # Подготавливаем данные для bulk insert
             values = []
-            for row in rows:
+            for row in fresh_rows:
                 values.append((
                     row["restaurant_name"],
                     row["source"],
                     row["stat_date"],
-                    json.dumps(row["payload"], ensure_ascii=False),
+                    row["payload_json"],
                     row["row_hash"],
                     row["sales_idr"],
                     row["orders_total"],
@@ -273,66 +505,109 @@ def upsert_stats_data(rows: List[Dict[str, Any]]) -> int:
                     row["delivery_time_min"],
                     row["offline_time_min"]
                 ))
-            
-            # Выполняем UPSERT
-            execute_values(cursor, upsert_sql, values, page_size=500)
-            
+
+            # COPY в staging-таблицу (без пер-строчного parse/plan на сервере),
+            # затем один set-based UPSERT с прежней hash-проверкой изменений
+            buf = io.StringIO()
+            csv.writer(buf).writerows(values)
+            buf.seek(0)
+
+            cursor.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS raw_stats_stage "
+                "(LIKE raw_stats INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+            )
+            cursor.copy_expert(
+                f"COPY raw_stats_stage ({_RAW_STATS_COLS}) FROM STDIN WITH (FORMAT csv)", buf
+            )
+            cursor.execute(_UPSERT_FROM_STAGE_SQL)
+
             # Получаем количество измененных записей
             updated_count = cursor.rowcount
+
+            # Витрина догоняется в той же транзакции: O(staged ключей)
+            # вместо REFRESH по всей истории raw_stats
+            cursor.execute(_DAILY_METRICS_FROM_STAGE_SQL)
             conn.commit()
-            
+
+            _invalidate_last_loaded_cache()
             logger.info(f"UPSERT completed: {updated_count} records updated")
             return updated_count
 
 
+# Карта (ресторан, источник) -> MAX(stat_date): один GROUP BY на процесс
+# вместо запроса на каждый вызов; сбрасывается после записи апсертом
+_LAST_LOADED_CACHE: Dict = {}
+_LAST_LOADED_LOCK = threading.Lock()
+
+
+def _last_loaded_map() -> Dict:
+    with _LAST_LOADED_LOCK:
+        if "map" not in _LAST_LOADED_CACHE:
+            with _get_db_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(
+                        "SELECT restaurant_name, source, MAX(stat_date) "
+                        "FROM raw_stats GROUP BY restaurant_name, source"
+                    )
+                    _LAST_LOADED_CACHE["map"] = {(r, s): d for r, s, d in cursor.fetchall()}
+        return _LAST_LOADED_CACHE["map"]
+
+
+def _invalidate_last_loaded_cache() -> None:
+    with _LAST_LOADED_LOCK:
+        _LAST_LOADED_CACHE.clear()
+
+
 def get_last_loaded_date(restaurant_name: str, source: str) -> Optional[date]:
     """Получение последней загруженной даты для ресторана и источника"""
-    
-    query = """
-        SELECT MAX(stat_date) 
-        FROM raw_stats 
-        WHERE restaurant_name = %s AND source = %s
-    """
-    
     try:
-        with _get_db_connection() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute(query, (restaurant_name, source))
-                result = cursor.fetchone()
-                return result[0] if result and result[0] else None
+        return _last_loaded_map().get((restaurant_name, source))
     except Exception as e:
         logger.error(f"Error getting last loaded date: {e}")
         return None
 
 
+_REFRESH_LOCK = threading.Lock()
+
+
 def refresh_materialized_view():
-    """Обновление материализованной витрины"""
+    """Полная пересборка витрины daily_metrics.
+
+    Штатно витрина сопровождается инкрементально внутри
+    upsert_stats_data; этот путь нужен миграциям и ручному
+    восстановлению (COPY-загрузки пишут raw_stats напрямую). Лок
+    сериализует пересборку внутри процесса."""
     try:
-        with _get_db_connection() as conn:
+        with _REFRESH_LOCK, _get_db_connection() as conn:
             with conn.cursor() as cursor:
-                logger.info("Refreshing materialized view mv_daily_metrics...")
-                cursor.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY mv_daily_metrics")
+                logger.info("Rebuilding daily_metrics from raw_stats...")
+                cursor.execute("SELECT refresh_daily_metrics()")
                 conn.commit()
-                logger.info("Materialized view refreshed successfully")
+                logger.info("daily_metrics rebuilt successfully")
     except Exception as e:
-        logger.error(f"Error refreshing materialized view: {e}")
+        logger.error(f"Error refreshing daily_metrics: {e}")
         raise
 
 
-def add_ml_job(job_type: str, restaurant_name: str = None, payload: Dict = None):
-    """Добавление задачи в очередь ML"""
+def add_ml_job(job_type: str, restaurant_name: str = None, payload: Dict = None, conn=None):
+    """Добавление задачи в очередь ML.
+
+    conn позволяет встроить вставку в уже открытую транзакцию синка;
+    payload сериализует сам драйвер через Json-адаптер."""
+    job_row = (job_type, restaurant_name, Json(payload) if payload else None)
+    insert_sql = """
+        INSERT INTO ml_jobs (job_type, restaurant_name, payload)
+        VALUES (%s, %s, %s)
+    """
     try:
-        with _get_db_connection() as conn:
+        if conn is not None:
             with conn.cursor() as cursor:
-                cursor.execute(
-                    """
-                    INSERT INTO ml_jobs (job_type, restaurant_name, payload) 
-                    VALUES (%s, %s, %s)
-                    """,
-                    (job_type, restaurant_name, json.dumps(payload) if payload else None)
-                )
-                conn.commit()
-                logger.info(f"ML job added: {job_type} for {restaurant_name}")
+                cursor.execute(insert_sql, job_row)
+        else:
+            with _get_db_connection() as pooled:
+                with pooled.cursor() as cursor:
+                    cursor.execute(insert_sql, job_row)
+        logger.info(f"ML job added: {job_type} for {restaurant_name}")
     except Exception as e:
         logger.error(f"Error adding ML job: {e}")
 
@@ -370,37 +645,44 @@ def run_incremental_sync(restaurant_name: str, source: str, start_date: Optional
         return {"status": "up_to_date", "records_updated": 0}
     
     logger.info(f"Starting incremental sync for {restaurant_name} ({source}): {start_date} to {end_date}")
-    
-    total_records_updated = 0
+
+    # Чанки по 14 дней
+    chunk_ranges = []
     current_start = start_date
-    
-    # Загружаем чанками по 14 дней
     while current_start <= end_date:
         current_end = min(current_start + timedelta(days=CHUNK_DAYS - 1), end_date)
-        
-        try:
-            # Получаем данные из API
-            api_response = fetch_restaurant_stats(restaurant_name, source, current_start, current_end)
-            
-            # Нормализуем данные
-            normalized_rows = _normalize_api_data(api_response)
-            
-            # Сохраняем в БД
-            updated_count = upsert_stats_data(normalized_rows)
-            total_records_updated += updated_count
-            
-            logger.info(f"Chunk {current_start} to {current_end}: {updated_count} records updated")
-            
-        except Exception as e:
-            logger.error(f"Error processing chunk {current_start} to {current_end}: {e}")
-            # Продолжаем со следующим чанком
-        
+        chunk_ranges.append((current_start, current_end))
         current_start = current_end + timedelta(days=1)
+
+    total_records_updated = 0
+
+    # Сетевые запросы тянем параллельно — суммарная латентность чанков
+    # схлопывается до ~одной; нормализация и запись идут по готовности
+    with ThreadPoolExecutor(max_workers=min(4, len(chunk_ranges))) as ex:
+        futures = [
+            (c_start, c_end, ex.submit(fetch_restaurant_stats, restaurant_name, source, c_start, c_end))
+            for c_start, c_end in chunk_ranges
+        ]
+        for c_start, c_end, future in futures:
+            try:
+                api_response = future.result()
+
+                # Нормализуем данные
+                normalized_rows = _normalize_api_data(api_response)
+
+                # Сохраняем в БД
+                updated_count = upsert_stats_data(normalized_rows)
+                total_records_updated += updated_count
+
+                logger.info(f"Chunk {c_start} to {c_end}: {updated_count} records updated")
+
+            except Exception as e:
+                logger.error(f"Error processing chunk {c_start} to {c_end}: {e}")
+                # Продолжаем со следующим чанком
     
-    # Обновляем витрину данных
+    # Витрина daily_metrics обновлена инкрементально самим апсертом —
+    # полный refresh здесь больше не нужен
     if total_records_updated > 0:
-        refresh_materialized_view()
-        
         # Добавляем задачу на переобучение ML если много новых данных
         if total_records_updated >= 30:
             add_ml_job("retrain", restaurant_name, {
@@ -422,19 +704,24 @@ def run_incremental_sync(restaurant_name: str, source: str, start_date: Optional
 
 
 def sync_all_sources(restaurant_name: str, start_date: Optional[date] = None, end_date: Optional[date] = None) -> Dict[str, Any]:
-    """Синхронизация данных для всех источников (GRAB + GOJEK)"""
-    
+    """Синхронизация данных для всех источников (GRAB + GOJEK) параллельно"""
+
     results = {}
     total_updated = 0
-    
-    for source in ['grab', 'gojek']:
-        try:
-            result = run_incremental_sync(restaurant_name, source, start_date, end_date)
-            results[source] = result
-            total_updated += result.get('records_updated', 0)
-        except Exception as e:
-            logger.error(f"Error syncing {source} for {restaurant_name}: {e}")
-            results[source] = {"status": "error", "error": str(e)}
+
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        futures = {
+            source: ex.submit(run_incremental_sync, restaurant_name, source, start_date, end_date)
+            for source in ['grab', 'gojek']
+        }
+        for source, future in futures.items():
+            try:
+                result = future.result()
+                results[source] = result
+                total_updated += result.get('records_updated', 0)
+            except Exception as e:
+                logger.error(f"Error syncing {source} for {restaurant_name}: {e}")
+                results[source] = {"status": "error", "error": str(e)}
     
     return {
         "restaurant_name": restaurant_name,
@@ -444,6 +731,36 @@ def sync_all_sources(restaurant_name: str, start_date: Optional[date] = None, en
     }
 
 
+def sync_many(restaurants: List[str], start_date: Optional[date] = None, end_date: Optional[date] = None,
+              max_workers: int = 4) -> Dict[str, Any]:
+    """Флитовая синхронизация: рестораны обрабатываются пулом воркеров.
+
+    Каждый воркер гоняет sync_all_sources своего ресторана; пул соединений
+    и HTTP-сессия общие, так что память и число коннектов остаются
+    ограниченными при любом размере флота."""
+    results: Dict[str, Any] = {}
+    total_updated = 0
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, max(1, len(restaurants)))) as ex:
+        futures = {
+            name: ex.submit(sync_all_sources, name, start_date, end_date)
+            for name in restaurants
+        }
+        for name, future in futures.items():
+            try:
+                result = future.result()
+                results[name] = result
+                total_updated += result.get('total_records_updated', 0)
+            except Exception as e:
+                logger.error(f"Error syncing restaurant {name}: {e}")
+                results[name] = {"status": "error", "error": str(e)}
+
+    return {
+        "restaurants": results,
+        "total_records_updated": total_updated,
+    }
+
+
 def get_available_restaurants() -> List[str]:
     """Получение списка ресторанов из БД"""
     try:
@@ -483,8 +800,9 @@ def get_data_quality_report(restaurant_name: str = None) -> Dict[str, Any]:
                     GROUP BY restaurant_name
                     ORDER BY restaurant_name
                 """, params)
-                
-                return {"restaurants": [dict(row) for row in cursor.fetchall()]}
+
+                # RealDictCursor уже отдаёт dict-строки — копия на строку не нужна
+                return {"restaurants": cursor.fetchall()}
     except Exception as e:
         logger.error(f"Error generating data quality report: {e}")
         return {"error": str(e)}
@@ -7,6 +7,7 @@ import os
 import sys
 import logging
 from datetime import date, datetime
+from typing import Any, Dict
 
 import psycopg2
 from psycopg2.extras import RealDictCursor
@@ -20,80 +21,201 @@ logger = logging.getLogger(__name__)
 DB_DSN = os.getenv("DATABASE_URL")
 
 
-def create_daily_facts_view():
-    """Создание витрины daily_facts"""
-    
-    sql = """
-    DROP MATERIALIZED VIEW IF EXISTS daily_facts CASCADE;
-    
-    CREATE MATERIALIZED VIEW daily_facts AS
-    SELECT 
+# daily_facts живёт обычной таблицей: полный DROP/CREATE MATERIALIZED VIEW
+# пере-агрегировал всю историю raw_stats на каждом прогоне, а UPSERT по
+# дельте стоит O(новых строк)
+_DAILY_FACTS_DDL = """
+    -- Унаследованная матвью уступает место таблице
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM pg_matviews WHERE matviewname = 'daily_facts') THEN
+            EXECUTE 'DROP MATERIALIZED VIEW daily_facts CASCADE';
+        END IF;
+    END $$;
+
+    CREATE TABLE IF NOT EXISTS daily_facts (
+        restaurant_id       integer,
+        restaurant_name     text NOT NULL,
+        stat_date           date NOT NULL,
+        grab_sales          double precision,
+        gojek_sales         double precision,
+        total_sales         double precision,
+        grab_orders         double precision,
+        gojek_orders        double precision,
+        total_orders        double precision,
+        grab_ads_spend      double precision,
+        gojek_ads_spend     double precision,
+        total_ads_spend     double precision,
+        grab_ads_sales      double precision,
+        gojek_ads_sales     double precision,
+        total_ads_sales     double precision,
+        grab_cancelled      double precision,
+        gojek_cancelled     double precision,
+        total_cancelled     double precision,
+        gojek_lost          double precision,
+        grab_rating         double precision,
+        gojek_rating        double precision,
+        gojek_prep_time     double precision,
+        gojek_confirm_time  double precision,
+        gojek_delivery_time double precision,
+        grab_offline_min    double precision,
+        sources_count       integer,
+        last_updated        timestamptz,
+        PRIMARY KEY (restaurant_name, stat_date)
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_daily_facts_restaurant_date ON daily_facts(restaurant_id, stat_date);
+    CREATE INDEX IF NOT EXISTS idx_daily_facts_date ON daily_facts(stat_date);
+"""
+
+_DAILY_FACTS_SELECT = """
+    SELECT
         rm.restaurant_id,
         rs.restaurant_name,
         rs.stat_date,
-        
+
         -- Агрегированные метрики по дню
         SUM(CASE WHEN rs.source = 'grab' THEN rs.sales_idr ELSE 0 END) as grab_sales,
         SUM(CASE WHEN rs.source = 'gojek' THEN rs.sales_idr ELSE 0 END) as gojek_sales,
         SUM(rs.sales_idr) as total_sales,
-        
+
         SUM(CASE WHEN rs.source = 'grab' THEN rs.orders_total ELSE 0 END) as grab_orders,
         SUM(CASE WHEN rs.source = 'gojek' THEN rs.orders_total ELSE 0 END) as gojek_orders,
         SUM(rs.orders_total) as total_orders,
-        
+
         SUM(CASE WHEN rs.source = 'grab' THEN rs.ads_spend_idr ELSE 0 END) as grab_ads_spend,
         SUM(CASE WHEN rs.source = 'gojek' THEN rs.ads_spend_idr ELSE 0 END) as gojek_ads_spend,
         SUM(rs.ads_spend_idr) as total_ads_spend,
-        
+
         SUM(CASE WHEN rs.source = 'grab' THEN rs.ads_sales_idr ELSE 0 END) as grab_ads_sales,
         SUM(CASE WHEN rs.source = 'gojek' THEN rs.ads_sales_idr ELSE 0 END) as gojek_ads_sales,
         SUM(rs.ads_sales_idr) as total_ads_sales,
-        
+
         -- Операционные метрики
         SUM(CASE WHEN rs.source = 'grab' THEN rs.cancelled_orders ELSE 0 END) as grab_cancelled,
         SUM(CASE WHEN rs.source = 'gojek' THEN rs.cancelled_orders ELSE 0 END) as gojek_cancelled,
         SUM(rs.cancelled_orders) as total_cancelled,
-        
+
         SUM(CASE WHEN rs.source = 'gojek' THEN rs.lost_orders ELSE 0 END) as gojek_lost,
-        
+
         -- Средние рейтинги
         AVG(CASE WHEN rs.source = 'grab' AND rs.rating_avg > 0 THEN rs.rating_avg END) as grab_rating,
         AVG(CASE WHEN rs.source = 'gojek' AND rs.rating_avg > 0 THEN rs.rating_avg END) as gojek_rating,
-        
+
         -- Операционные времена (только GOJEK)
         AVG(CASE WHEN rs.source = 'gojek' AND rs.prep_time_min > 0 THEN rs.prep_time_min END) as gojek_prep_time,
         AVG(CASE WHEN rs.source = 'gojek' AND rs.confirm_time_min > 0 THEN rs.confirm_time_min END) as gojek_confirm_time,
         AVG(CASE WHEN rs.source = 'gojek' AND rs.delivery_time_min > 0 THEN rs.delivery_time_min END) as gojek_delivery_time,
-        
+
         -- Время оффлайн (GRAB)
         SUM(CASE WHEN rs.source = 'grab' THEN rs.offline_time_min ELSE 0 END) as grab_offline_min,
-        
+
         -- Метаданные
         COUNT(*) as sources_count,  -- Должно быть 2 (grab + gojek)
         MAX(rs.updated_at) as last_updated
-        
+
     FROM raw_stats rs
     LEFT JOIN restaurant_mapping rm ON rs.restaurant_name = rm.restaurant_name
-    WHERE rm.is_active IS TRUE OR rm.is_active IS NULL
-    GROUP BY rm.restaurant_id, rs.restaurant_name, rs.stat_date;
-    
-    -- Индексы для витрины
-    CREATE INDEX idx_daily_facts_restaurant_date ON daily_facts(restaurant_id, stat_date);
-    CREATE INDEX idx_daily_facts_date ON daily_facts(stat_date);
-    CREATE INDEX idx_daily_facts_restaurant ON daily_facts(restaurant_name);
+    WHERE (rm.is_active IS TRUE OR rm.is_active IS NULL){date_filter}
+    GROUP BY rm.restaurant_id, rs.restaurant_name, rs.stat_date
+"""
+
+_DAILY_FACTS_UPSERT_TAIL = """
+    ON CONFLICT (restaurant_name, stat_date) DO UPDATE SET
+        restaurant_id = EXCLUDED.restaurant_id,
+        grab_sales = EXCLUDED.grab_sales,
+        gojek_sales = EXCLUDED.gojek_sales,
+        total_sales = EXCLUDED.total_sales,
+        grab_orders = EXCLUDED.grab_orders,
+        gojek_orders = EXCLUDED.gojek_orders,
+        total_orders = EXCLUDED.total_orders,
+        grab_ads_spend = EXCLUDED.grab_ads_spend,
+        gojek_ads_spend = EXCLUDED.gojek_ads_spend,
+        total_ads_spend = EXCLUDED.total_ads_spend,
+        grab_ads_sales = EXCLUDED.grab_ads_sales,
+        gojek_ads_sales = EXCLUDED.gojek_ads_sales,
+        total_ads_sales = EXCLUDED.total_ads_sales,
+        grab_cancelled = EXCLUDED.grab_cancelled,
+        gojek_cancelled = EXCLUDED.gojek_cancelled,
+        total_cancelled = EXCLUDED.total_cancelled,
+        gojek_lost = EXCLUDED.gojek_lost,
+        grab_rating = EXCLUDED.grab_rating,
+        gojek_rating = EXCLUDED.gojek_rating,
+        gojek_prep_time = EXCLUDED.gojek_prep_time,
+        gojek_confirm_time = EXCLUDED.gojek_confirm_time,
+        gojek_delivery_time = EXCLUDED.gojek_delivery_time,
+        grab_offline_min = EXCLUDED.grab_offline_min,
+        sources_count = EXCLUDED.sources_count,
+        last_updated = EXCLUDED.last_updated
+"""
+
+
+def init_daily_facts_table():
+    """Создание таблицы daily_facts и её индексов (идемпотентно)"""
+    try:
+        with psycopg2.connect(DB_DSN) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(_DAILY_FACTS_DDL)
+                conn.commit()
+                return True
+    except Exception as e:
+        logger.error(f"❌ Error creating daily_facts table: {e}")
+        return False
+
+
+def refresh_daily_facts(since=None):
+    """Инкрементальное обновление daily_facts.
+
+    Порог по умолчанию — MAX(last_updated) витрины; пере-агрегируются
+    целиком те дни (ресторан, дата), где raw_stats.updated_at пересёк
+    порог. Ловит и новые дни, и backfill-правки старых дат, оставаясь
+    O(изменённых дней) вместо O(всей истории raw_stats).
     """
-    
     try:
         with psycopg2.connect(DB_DSN) as conn:
             with conn.cursor() as cursor:
-                logger.info("Creating daily_facts materialized view...")
-                cursor.execute(sql)
+                if since is None:
+                    cursor.execute("SELECT MAX(last_updated) FROM daily_facts")
+                    since = cursor.fetchone()[0]
+
+                if since is None:
+                    date_filter = ""
+                    params = ()
+                    logger.info("Rebuilding daily_facts from full history...")
+                else:
+                    # Дни агрегируются целиком: фильтр отбирает ключи дней с
+                    # изменениями, а не отдельные изменённые строки
+                    date_filter = (
+                        " AND (rs.restaurant_name, rs.stat_date) IN ("
+                        "SELECT restaurant_name, stat_date FROM raw_stats WHERE updated_at >= %s)"
+                    )
+                    params = (since,)
+                    logger.info(f"Refreshing daily_facts changed since {since}...")
+
+                cursor.execute(
+                    "INSERT INTO daily_facts "
+                    + _DAILY_FACTS_SELECT.format(date_filter=date_filter)
+                    + _DAILY_FACTS_UPSERT_TAIL,
+                    params,
+                )
+                updated = cursor.rowcount
                 conn.commit()
-                logger.info("✅ daily_facts view created successfully")
+                logger.info(f"✅ daily_facts refreshed: {updated} rows upserted")
                 return True
     except Exception as e:
-        logger.error(f"❌ Error creating daily_facts view: {e}")
+        logger.error(f"❌ Error refreshing daily_facts: {e}")
+        return False
+
+
+def create_daily_facts_view():
+    """Создание витрины daily_facts (таблица + полное заполнение)"""
+    logger.info("Creating daily_facts table...")
+    if not init_daily_facts_table():
         return False
+    if not refresh_daily_facts():
+        return False
+    logger.info("✅ daily_facts created successfully")
+    return True
 
 
 def create_ml_dataset_view():
@@ -125,30 +247,23 @@ def create_ml_dataset_view():
         EXTRACT(DOW FROM df.stat_date) as day_of_week,
         CASE WHEN EXTRACT(DOW FROM df.stat_date) IN (0, 6) THEN 1 ELSE 0 END as is_weekend,
         
-        -- Лаги (простая реализация через window functions)
-        LAG(df.total_sales, 1) OVER (PARTITION BY df.restaurant_id ORDER BY df.stat_date) as total_sales_lag_1,
-        LAG(df.total_sales, 3) OVER (PARTITION BY df.restaurant_id ORDER BY df.stat_date) as total_sales_lag_3,
-        LAG(df.total_sales, 7) OVER (PARTITION BY df.restaurant_id ORDER BY df.stat_date) as total_sales_lag_7,
-        
-        LAG(df.total_orders, 1) OVER (PARTITION BY df.restaurant_id ORDER BY df.stat_date) as orders_lag_1,
-        LAG(df.total_orders, 3) OVER (PARTITION BY df.restaurant_id ORDER BY df.stat_date) as orders_lag_3,
-        LAG(df.total_orders, 7) OVER (PARTITION BY df.restaurant_id ORDER BY df.stat_date) as orders_lag_7,
-        
-        -- Скользящие средние
-        AVG(df.total_sales) OVER (
-            PARTITION BY df.restaurant_id 
-            ORDER BY df.stat_date 
-            ROWS BETWEEN 6 PRECEDING AND CURRENT ROW
-        ) as total_sales_rolling_7d,
-        
-        AVG(df.total_orders) OVER (
-            PARTITION BY df.restaurant_id 
-            ORDER BY df.stat_date 
-            ROWS BETWEEN 6 PRECEDING AND CURRENT ROW
-        ) as orders_rolling_7d
-        
+        -- Лаги: один именованный WINDOW — планировщик строит единственный
+        -- WindowAgg/Sort вместо пересортировки на каждый OVER(...)
+        LAG(df.total_sales, 1) OVER w as total_sales_lag_1,
+        LAG(df.total_sales, 3) OVER w as total_sales_lag_3,
+        LAG(df.total_sales, 7) OVER w as total_sales_lag_7,
+
+        LAG(df.total_orders, 1) OVER w as orders_lag_1,
+        LAG(df.total_orders, 3) OVER w as orders_lag_3,
+        LAG(df.total_orders, 7) OVER w as orders_lag_7,
+
+        -- Скользящие средние (общая рамка, смежные определения)
+        AVG(df.total_sales) OVER (w ROWS BETWEEN 6 PRECEDING AND CURRENT ROW) as total_sales_rolling_7d,
+        AVG(df.total_orders) OVER (w ROWS BETWEEN 6 PRECEDING AND CURRENT ROW) as orders_rolling_7d
+
     FROM daily_facts df
     LEFT JOIN weather_cache wc ON wc.restaurant_id = df.restaurant_id AND wc.date = df.stat_date
+    WINDOW w AS (PARTITION BY df.restaurant_id ORDER BY df.stat_date)
     ORDER BY df.restaurant_id, df.stat_date;
     
     -- Индексы для ML dataset
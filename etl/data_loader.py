@@ -48,7 +48,9 @@ def get_engine(sqlite_path: Optional[str] = None) -> Engine:
     """Create SQLAlchemy engine for SQLite."""
     db_path = sqlite_path or DEFAULT_SQLITE_PATH
     conn_str = f"sqlite:///{db_path}"
-    engine = create_engine(conn_str, future=True)
+    # Пул соединений может отдавать коннект другому потоку (секции отчёта
+    # строятся параллельно) — для чтения SQLite это безопасно
+    engine = create_engine(conn_str, future=True, connect_args={"check_same_thread": False})
     return engine
 
 
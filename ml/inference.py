@@ -49,6 +49,30 @@ def load_artifacts(artifact_dir: str = ARTIFACT_DIR):
     return _CACHE[key]
 
 
+_EXPLAINER_CACHE: Dict[str, tuple] = {}
+
+
+def load_explainer(artifact_dir: str = ARTIFACT_DIR):
+    """Return (model, features, pre, mdl, explainer) with a ready TreeExplainer.
+
+    Transforming the SHAP background and constructing the explainer is the
+    expensive prologue of every attribution call site; cache the result per
+    artifact dir so all report sections share one instance per process."""
+    key = os.path.abspath(artifact_dir)
+    if key in _EXPLAINER_CACHE:
+        return _EXPLAINER_CACHE[key]
+    model, features, background = load_artifacts(artifact_dir)
+    pre: ColumnTransformer = model.named_steps["pre"]
+    mdl = model.named_steps["model"]
+    if background is not None and not background.empty:
+        bg_pre = pre.transform(background[features])
+        explainer = shap.TreeExplainer(mdl, data=bg_pre, feature_perturbation="interventional")
+    else:
+        explainer = shap.TreeExplainer(mdl, feature_perturbation="interventional")
+    _EXPLAINER_CACHE[key] = (model, features, pre, mdl, explainer)
+    return _EXPLAINER_CACHE[key]
+
+
 def load_model_pickle(artifact_dir: str = ARTIFACT_DIR):
     path = os.path.join(artifact_dir, "model.pkl")
     if not os.path.exists(path):
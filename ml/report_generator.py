@@ -15,9 +15,12 @@ import numpy as np
 import pandas as pd
 
 
+_SPACE_TRANS = str.maketrans(",", " ")
+
+
 def _fmt_idr(x: float) -> str:
     try:
-        return f"{int(round(x)):,.0f} IDR".replace(",", " ")
+        return f"{int(round(x)):,.0f} IDR".translate(_SPACE_TRANS)
     except Exception:
         return str(x)
 